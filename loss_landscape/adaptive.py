@@ -0,0 +1,94 @@
+"""
+    Adaptive quadtree refinement of 2D surfaces.
+
+    The surface is first sampled on a coarse sub-grid of the dense grid. Cells are
+    recursively split into four where the loss varies or bends more than a tolerance,
+    and the dense grid is filled in by interpolating the non-uniform samples.
+    Unsampled cells are NaN in the sample arrays.
+"""
+
+import numpy as np
+from scipy.interpolate import griddata
+
+
+def coarse_indices(n, stride):
+    """ Indices of a sub-grid with the given stride, always including the last index. """
+    return np.unique(np.append(np.arange(0, n, stride), n - 1))
+
+
+def initial_cells(shape, stride):
+    """ Return the cells (i0, i1, j0, j1) and the mask of the points of the coarse grid. """
+    rows, cols = coarse_indices(shape[0], stride), coarse_indices(shape[1], stride)
+    cells = [(i0, i1, j0, j1) for i0, i1 in zip(rows[:-1], rows[1:])
+                              for j0, j1 in zip(cols[:-1], cols[1:])]
+    mask = np.zeros(shape, dtype=bool)
+    mask[np.ix_(rows, cols)] = True
+    return cells, mask
+
+
+def cell_error(Z, cell):
+    """ Estimate how badly bilinear interpolation represents the values in a cell.
+
+        The error is the larger of the variation of the values at the corners and
+        the second differences at the corners, computed with the sampled points one
+        cell size outside of the cell.
+    """
+    i0, i1, j0, j1 = cell
+    corners = Z[np.ix_([i0, i1], [j0, j1])]
+    error = corners.max() - corners.min()
+
+    hi, hj = i1 - i0, j1 - j0
+    for j in [j0, j1]:
+        if i0 - hi >= 0:
+            error = max(error, abs(Z[i0 - hi, j] - 2 * Z[i0, j] + Z[i1, j]))
+        if i1 + hi < Z.shape[0]:
+            error = max(error, abs(Z[i0, j] - 2 * Z[i1, j] + Z[i1 + hi, j]))
+    for i in [i0, i1]:
+        if j0 - hj >= 0:
+            error = max(error, abs(Z[i, j0 - hj] - 2 * Z[i, j0] + Z[i, j1]))
+        if j1 + hj < Z.shape[1]:
+            error = max(error, abs(Z[i, j0] - 2 * Z[i, j1] + Z[i, j1 + hj]))
+    # the second differences with unsampled neighbors are NaN and ignored by max
+    return error
+
+
+def refine(Z, cells, tol):
+    """ Split the cells whose error exceeds tol.
+
+        Args:
+          Z: the sampled values, NaN where not sampled
+          cells: the current leaf cells (i0, i1, j0, j1)
+          tol: the tolerance on the variation/curvature in the cells
+
+        Returns:
+          - the cells to be examined at the next level
+          - the mask of the points that have to be sampled for these cells
+    """
+    new_cells = []
+    mask = np.zeros(Z.shape, dtype=bool)
+    for cell in cells:
+        i0, i1, j0, j1 = cell
+        if (i1 - i0 <= 1 and j1 - j0 <= 1) or not cell_error(Z, cell) > tol:
+            continue
+        rows = np.unique([i0, (i0 + i1) // 2, i1])
+        cols = np.unique([j0, (j0 + j1) // 2, j1])
+        new_cells += [(a0, a1, b0, b1) for a0, a1 in zip(rows[:-1], rows[1:])
+                                       for b0, b1 in zip(cols[:-1], cols[1:])]
+        mask[np.ix_(rows, cols)] = True
+    return new_cells, mask & np.isnan(Z)
+
+
+def interpolate(Z):
+    """ Fill in the unsampled (NaN) points of Z by linear interpolation of the samples,
+        and with the nearest sample outside of their convex hull.
+    """
+    sampled = ~np.isnan(Z)
+    if sampled.all():
+        return Z.copy()
+    points = np.argwhere(sampled)
+    grid = tuple(np.indices(Z.shape))
+    dense = griddata(points, Z[sampled], grid, method='linear')
+    outside = np.isnan(dense)
+    if outside.any():
+        dense[outside] = griddata(points, Z[sampled], grid, method='nearest')[outside]
+    return dense
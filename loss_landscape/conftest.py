@@ -0,0 +1,22 @@
+import pytest
+import torch
+import torch.nn as nn
+
+
+@pytest.fixture
+def make_net():
+    """ A factory that builds a model seeded with torch.manual_seed(0), with random
+        BN statistics and affine parameters, in eval mode.
+    """
+    def make(model):
+        torch.manual_seed(0)
+        net = model()
+        for m in net.modules():
+            if isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                m.running_mean.normal_()
+                m.running_var.uniform_(0.5, 2)
+                if m.affine:
+                    m.weight.data.normal_()
+                    m.bias.data.normal_()
+        return net.eval()
+    return make
@@ -4,15 +4,29 @@ from torchvision import transforms
 import os
 import numpy as np
 import argparse
+import h5_util
 
 def get_relative_path(file):
     script_dir = os.path.dirname(__file__)  # <-- absolute dir the script is in
     return os.path.join(script_dir, file)
 
 
+def get_split_indices(num_data, data_split):
+    """ Randomly sample 1/data_split of the indices, reproducibly (seed=0). """
+    indices = np.arange(num_data)
+    data_num = num_data // data_split # the number of data in a chunk of the split
+
+    # Randomly sample indices. Use seed=0 in the generator to make this reproducible
+    state = np.random.get_state()
+    np.random.seed(0)
+    indices = np.random.choice(indices, data_num, replace=False)
+    np.random.set_state(state)
+    return indices
+
+
 def load_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
                  threads=2, raw_data=False, data_split=1, split_idx=0, \
-                 trainloader_path="", testloader_path=""):
+                 trainloader_path="", testloader_path="", shuffle=False):
     """
     Setup dataloader. The data is not randomly cropped as in training because of
     we want to esimate the loss value with a fixed dataset.
@@ -21,6 +35,7 @@ def load_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
         raw_data: raw images, no data preprocessing
         data_split: the number of splits for the training dataloader
         split_idx: the index for the split of the dataloader, starting at 0
+        shuffle: serve the training data in a random order
 
     Returns:
         train_loader, test_loader
@@ -56,15 +71,7 @@ def load_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
         # If data_split>1, then randomly select a subset of the data. E.g., if datasplit=3, then
         # randomly choose 1/3 of the data.
         if data_split > 1:
-            indices = torch.tensor(np.arange(len(trainset)))
-            data_num = len(trainset) // data_split # the number of data in a chunk of the split
-
-            # Randomly sample indices. Use seed=0 in the generator to make this reproducible
-            state = np.random.get_state()
-            np.random.seed(0)
-            indices = np.random.choice(indices, data_num, replace=False)
-            np.random.set_state(state)
-
+            indices = get_split_indices(len(trainset), data_split)
             train_sampler = torch.utils.data.sampler.SubsetRandomSampler(indices)
             train_loader = torch.utils.data.DataLoader(trainset, batch_size=batch_size,
                                                        sampler=train_sampler,
@@ -72,7 +79,7 @@ def load_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
         else:
             kwargs = {'num_workers': 2, 'pin_memory': True}
             train_loader = torch.utils.data.DataLoader(trainset, batch_size=batch_size,
-                                                      shuffle=False, **kwargs)
+                                                      shuffle=shuffle, **kwargs)
         testset = torchvision.datasets.CIFAR10(root=data_folder, train=False,
                                                download=False, transform=transform)
         test_loader = torch.utils.data.DataLoader(testset, batch_size=batch_size,
@@ -81,6 +88,175 @@ def load_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
     return train_loader, test_loader
 
 
+class TensorBatchLoader(object):
+    """
+    Serve batches as contiguous slices of pre-decoded and pre-normalized arrays,
+    without per-sample Python transforms. The arrays are memory mapped from .npy
+    files (copy-on-write), so that processes on the same node share the pages.
+
+    With shuffle=True the samples are served in a random order, which is fixed by
+    the seed, so that every pass (and every process) sees the same batches.
+    """
+
+    def __init__(self, data_file, label_file, batch_size=128, shuffle=False, seed=0):
+        self.data_file = data_file
+        self.label_file = label_file
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.open()
+
+    def open(self):
+        self.data = np.load(self.data_file, mmap_mode='c')
+        self.labels = np.load(self.label_file, mmap_mode='c')
+        assert len(self.data) == len(self.labels)
+        self.order = np.random.RandomState(self.seed).permutation(len(self.data)) if self.shuffle else None
+
+    def __len__(self):
+        return (len(self.data) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for start in range(0, len(self.data), self.batch_size):
+            stop = start + self.batch_size
+            if self.order is None:
+                yield torch.from_numpy(self.data[start:stop]), torch.from_numpy(self.labels[start:stop])
+            else:
+                # sorted indices read the memory mapped file sequentially
+                inds = np.sort(self.order[start:stop])
+                yield torch.from_numpy(self.data[inds]), torch.from_numpy(self.labels[inds])
+
+    def __getstate__(self):
+        # only pickle the file names, the arrays are mapped again after unpickling
+        return {'data_file': self.data_file, 'label_file': self.label_file,
+                'batch_size': self.batch_size, 'shuffle': self.shuffle, 'seed': self.seed}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+
+def cache_split(data_folder, cache_prefix, train, raw_data, data_split=1):
+    """
+    Decode (and normalize) a CIFAR10 split once and save it as float32 NCHW and
+    int64 label .npy files. The files are written under temporary names first,
+    so concurrent readers never see a partial cache, see h5_util.atomic_save.
+    """
+    data_file, label_file = cache_prefix + '_data.npy', cache_prefix + '_labels.npy'
+    if os.path.exists(data_file) and os.path.exists(label_file):
+        return data_file, label_file
+
+    dataset = torchvision.datasets.CIFAR10(root=data_folder, train=train, download=True)
+    data, labels = dataset.data, np.array(dataset.targets, dtype=np.int64)
+    if data_split > 1:
+        # the same subset of the data as in load_dataset, the order of the
+        # samples does not matter for the averaged loss
+        indices = np.sort(get_split_indices(len(dataset), data_split))
+        data, labels = data[indices], labels[indices]
+
+    # same as transforms.ToTensor() followed by transforms.Normalize()
+    data = data.transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+    if not raw_data:
+        mean = np.array([x/255.0 for x in [125.3, 123.0, 113.9]], dtype=np.float32)
+        std = np.array([x/255.0 for x in [63.0, 62.1, 66.7]], dtype=np.float32)
+        data = (data - mean[:, None, None]) / std[:, None, None]
+
+    h5_util.atomic_save(data_file, np.ascontiguousarray(data))
+    h5_util.atomic_save(label_file, labels)
+
+    return data_file, label_file
+
+
+def check_cache_dir(cache_dir, trainloader_path="", testloader_path=""):
+    """ Check that a cache_dir is not combined with the custom loaders of load_dataset. """
+    if cache_dir:
+        assert not (trainloader_path or testloader_path), \
+            '--cache_dir caches the CIFAR10 labels, not those of --trainloader/--testloader'
+
+
+def load_cached_dataset(dataset='cifar10', datapath='cifar10/data', batch_size=128, \
+                        raw_data=False, data_split=1, split_idx=0, cache_dir='', shuffle=False):
+    """
+    Setup loaders that serve the evaluation data from pre-decoded, pre-normalized
+    .npy files in cache_dir (preferably on a local disk). No data augmentation is
+    used for surface evaluation, so the transforms only need to run once.
+
+    Args:
+        raw_data: raw images, no data preprocessing
+        data_split: the number of splits for the training dataloader
+        split_idx: the index for the split of the dataloader, starting at 0
+        cache_dir: the folder of the cached .npy files
+        shuffle: serve the training data in a fixed random order
+
+    Returns:
+        train_loader, test_loader
+    """
+
+    assert split_idx < data_split, 'the index of data partition should be smaller than the total number of split'
+    assert dataset == 'cifar10', 'the cached dataset is only available for cifar10'
+
+    data_folder = get_relative_path(datapath)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    prefix = os.path.join(cache_dir, dataset)
+    if raw_data:
+        prefix += '_rawdata'
+
+    train_prefix = prefix + '_train'
+    if data_split > 1:
+        train_prefix += '_datasplit=' + str(data_split) + '_splitidx=' + str(split_idx)
+
+    train_loader = TensorBatchLoader(*cache_split(data_folder, train_prefix, True, raw_data, data_split),
+                                     batch_size=batch_size, shuffle=shuffle)
+    test_loader = TensorBatchLoader(*cache_split(data_folder, prefix + '_test', False, raw_data),
+                                    batch_size=batch_size)
+
+    return train_loader, test_loader
+
+
+def subsample_batches(loader, num_batches, seed=0):
+    """
+    Draw a reproducible random subsample of 'num_batches' batches from a loader,
+    with the samples drawn without replacement (by the seed) and batched in the
+    order of their indices. The batches are loaded into memory, so that repeated
+    passes, e.g., all Hessian-vector products of one eigensolve, see the same data.
+
+    Args:
+        loader: a torch DataLoader, a TensorBatchLoader, or any iterable of batches
+        num_batches: the number of batches of the subsample
+        seed: the seed of the subsample
+
+    Returns:
+        a list of (inputs, targets) batches
+    """
+    rng = np.random.RandomState(seed)
+    if isinstance(loader, TensorBatchLoader):
+        size = min(num_batches * loader.batch_size, len(loader.data))
+        inds = np.sort(rng.choice(len(loader.data), size, replace=False))
+        return [(torch.from_numpy(loader.data[b]), torch.from_numpy(loader.labels[b]))
+                for b in np.array_split(inds, range(loader.batch_size, size, loader.batch_size))]
+
+    if isinstance(loader, torch.utils.data.DataLoader) and loader.batch_size is not None:
+        # the samples the loader would serve, e.g., only the indices of a data split
+        pool = np.sort(np.fromiter(iter(loader.sampler), dtype=np.int64))
+        size = min(num_batches * loader.batch_size, len(pool))
+        inds = np.sort(rng.choice(pool, size, replace=False))
+        subset = torch.utils.data.Subset(loader.dataset, inds)
+        return list(torch.utils.data.DataLoader(subset, batch_size=loader.batch_size, shuffle=False,
+                                                num_workers=loader.num_workers))
+
+    # other loaders, e.g., pickled custom loaders, are only sampled batch-wise,
+    # and read up to the last picked batch
+    picked = set(rng.choice(len(loader), min(num_batches, len(loader)), replace=False))
+    batches = []
+    for i, batch in enumerate(loader):
+        if i in picked:
+            batches.append(batch)
+            if len(batches) == len(picked):
+                break
+    return batches
+
+
 ###############################################################
 ####                        MAIN
 ###############################################################
@@ -3,11 +3,18 @@
     the loss value, accuracy and eigen values of the hessian matrix
 """
 
+import math
 import torch
+import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 import time
 from torch.autograd.variable import Variable
+import tracing
+
+# the metrics supported by eval_metrics: the loss value, the top-1 and top-5 accuracy,
+# and the mean and standard deviation of the margin of the true class
+METRICS = ['loss', 'acc', 'top5', 'margin', 'margin_std']
 
 def eval_loss(net, criterion, loader, use_cuda=False):
     """
@@ -64,3 +71,310 @@ def eval_loss(net, criterion, loader, use_cuda=False):
                 correct += predicted.cpu().eq(targets).sum().item()
 
     return total_loss/total, 100.*correct/total
+
+
+def sample_losses(criterion, outputs, targets):
+    """ Return the loss of every sample of a batch as a float64 tensor. """
+    if isinstance(criterion, nn.CrossEntropyLoss):
+        losses = F.cross_entropy(outputs, targets, reduction='none')
+    elif isinstance(criterion, nn.MSELoss):
+        one_hot_targets = torch.zeros_like(outputs).scatter_(1, targets.view(-1, 1), 1.0)
+        losses = ((F.softmax(outputs, dim=1) - one_hot_targets) ** 2).mean(1)
+    return losses.double()
+
+
+def eval_sample_losses(net, criterion, loader, use_cuda=False):
+    """
+    Evaluate the loss of every sample, in the order of the loader.
+
+    Returns:
+        a float64 tensor of the per-sample losses
+    """
+    if use_cuda:
+        net.cuda()
+    net.eval()
+
+    losses = []
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(loader):
+            if use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            losses.append(sample_losses(criterion, net(inputs), targets).cpu())
+    return torch.cat(losses)
+
+
+def eval_loss_early_stop(net, criterion, loader, tol, max_samples=0, use_cuda=False, z=1.96,
+                         origin_losses=None):
+    """
+    Estimate the loss value for a given 'net' from the batches of a shuffled loader,
+    stopping as soon as the half width of the confidence interval of the mean loss,
+    z * stderr, falls below 'tol' or 'max_samples' samples have been evaluated.
+
+    If the per-sample losses of the unperturbed model are given (in the order of
+    the loader), they are used as a control variate: the mean loss is estimated as
+    mean(L) - beta * (mean(L0) - mean_all(L0)) with beta = cov(L, L0) / var(L0),
+    whose variance shrinks with the correlation of L and L0.
+
+    Args:
+        net: the neural net model
+        criterion: loss function
+        loader: dataloader, in random order
+        tol: the half width of the confidence interval, 0 to ignore
+        max_samples: the budget of samples, 0 for the whole dataset
+        use_cuda: use cuda or not
+        z: the quantile of the confidence interval, 1.96 for 95%
+        origin_losses: optional per-sample losses of the unperturbed model, see eval_sample_losses
+    Returns:
+        loss value, accuracy, standard error of the loss value and number of samples
+    """
+    correct = 0
+    total = 0 # number of samples
+    loss_sum, loss_sq = 0.0, 0.0
+    origin_sum, origin_sq, cross_sum = 0.0, 0.0, 0.0
+    loss, stderr = float('nan'), float('nan')
+    if origin_losses is not None:
+        origin_mean = origin_losses.mean().item()
+
+    if use_cuda:
+        net.cuda()
+    net.eval()
+
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(tracing.iterate(loader)):
+            batch_size = inputs.size(0)
+            if use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            with tracing.span('forward'):
+                outputs = net(inputs)
+            with tracing.span('metrics'):
+                losses = sample_losses(criterion, outputs, targets).cpu()
+                loss_sum += losses.sum().item()
+                loss_sq += (losses ** 2).sum().item()
+                if origin_losses is not None:
+                    origin = origin_losses[total:total + batch_size]
+                    origin_sum += origin.sum().item()
+                    origin_sq += (origin ** 2).sum().item()
+                    cross_sum += (losses * origin).sum().item()
+                total += batch_size
+                _, predicted = torch.max(outputs.data, 1)
+                correct += predicted.eq(targets).sum().item()
+
+            loss = loss_sum/total
+            if total > 1:
+                var = max(loss_sq/total - loss**2, 0.0)
+                if origin_losses is not None:
+                    origin_var = max(origin_sq/total - (origin_sum/total)**2, 0.0)
+                    cov = cross_sum/total - loss*origin_sum/total
+                    beta = cov/origin_var if origin_var > 0 else 0.0
+                    loss -= beta * (origin_sum/total - origin_mean)
+                    var = max(var - beta*cov, 0.0)
+                stderr = math.sqrt(var/(total - 1))
+                if (tol > 0 and z*stderr <= tol) or (max_samples > 0 and total >= max_samples):
+                    break
+
+    return loss, 100.*correct/total, stderr, total
+
+
+def metric_sums(criterion, outputs, targets, metrics):
+    """
+    Sum the per-sample values of the metrics over the samples of a batch.
+
+    Args:
+        criterion: loss function
+        outputs: ... x batch_size x classes, e.g., for K modified models at once
+        targets: the targets of the batch
+        metrics: names of the metrics, see METRICS
+    Returns:
+        a dict of tensors shaped like outputs.shape[:-2], with the sum of the
+        squared margins as 'margin_sq'
+    """
+    targets = targets.expand(outputs.shape[:-1])
+    true_outputs = outputs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+    sums = {}
+    if 'loss' in metrics:
+        if isinstance(criterion, nn.CrossEntropyLoss):
+            losses = torch.logsumexp(outputs, -1) - true_outputs
+        elif isinstance(criterion, nn.MSELoss):
+            one_hot_targets = torch.zeros_like(outputs).scatter_(-1, targets.unsqueeze(-1), 1.0)
+            losses = ((F.softmax(outputs, dim=-1) - one_hot_targets) ** 2).mean(-1)
+        sums['loss'] = losses.double().sum(-1)
+    if 'acc' in metrics:
+        sums['acc'] = outputs.argmax(-1).eq(targets).double().sum(-1)
+    if 'top5' in metrics:
+        _, top = outputs.topk(min(5, outputs.shape[-1]), -1)
+        sums['top5'] = top.eq(targets.unsqueeze(-1)).any(-1).double().sum(-1)
+    if 'margin' in metrics or 'margin_std' in metrics:
+        # the output of the true class minus the largest output of the other classes
+        others = outputs.scatter(-1, targets.unsqueeze(-1), float('-inf')).max(-1)[0]
+        margins = (true_outputs - others).double()
+        sums['margin'] = margins.sum(-1)
+        sums['margin_sq'] = (margins ** 2).sum(-1)
+    return sums
+
+
+def metric_values(sums, total, metrics):
+    """ Turn the sums of metric_sums over all batches into a ... x len(metrics) tensor. """
+    values = []
+    for metric in metrics:
+        if metric == 'loss':
+            values.append(sums['loss']/total)
+        elif metric in ['acc', 'top5']:
+            values.append(100.*sums[metric]/total)
+        elif metric == 'margin':
+            values.append(sums['margin']/total)
+        elif metric == 'margin_std':
+            values.append(torch.sqrt(torch.clamp(sums['margin_sq']/total - (sums['margin']/total)**2, min=0)))
+    return torch.stack(values, -1).cpu()
+
+
+def add_sums(total_sums, sums):
+    for key, value in sums.items():
+        total_sums[key] = total_sums[key] + value if key in total_sums else value
+    return total_sums
+
+
+def eval_metrics(net, criterion, loaders, metrics, use_cuda=False):
+    """
+    Evaluate the metrics for a given 'net' on the datasets of several loaders.
+
+    Args:
+        net: the neural net model
+        criterion: loss function
+        loaders: a list of dataloaders
+        metrics: names of the metrics, see METRICS
+        use_cuda: use cuda or not
+    Returns:
+        a list of the values of all metrics for every loader, loader by loader
+    """
+    if use_cuda:
+        net.cuda()
+    net.eval()
+
+    values = []
+    with torch.no_grad():
+        for loader in loaders:
+            sums, total = {}, 0
+            for batch_idx, (inputs, targets) in enumerate(tracing.iterate(loader)):
+                total += inputs.size(0)
+                if use_cuda:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+                with tracing.span('forward'):
+                    outputs = net(inputs)
+                with tracing.span('metrics'):
+                    add_sums(sums, metric_sums(criterion, outputs, targets, metrics))
+            with tracing.span('metrics'):
+                values += metric_values(sums, total, metrics).tolist()
+    return values
+
+
+def eval_metrics_points(net, criterion, loaders, perturbation, steps, metrics, use_cuda=False):
+    """
+    Evaluate the metrics of K modified models, each moved along the directions of
+    'perturbation' by one of the 'steps', on the datasets of several loaders.
+    The K models share one pass over the data: the parameters are stacked and the
+    forward is vectorized over them with torch.func.functional_call and vmap.
+
+    Args:
+        net: the neural net model
+        criterion: loss function
+        loaders: a list of dataloaders
+        perturbation: a net_plotter.FlatPerturbation of the net
+        steps: K coordinates (x or (x, y)) along the directions
+        metrics: names of the metrics, see METRICS
+        use_cuda: use cuda or not
+    Returns:
+        K lists of the values of all metrics for every loader, as in eval_metrics
+    """
+    from torch.func import functional_call, vmap
+
+    if use_cuda:
+        net.cuda()
+    net.eval()
+
+    def forward(params, inputs):
+        return functional_call(net, params, (inputs,))
+
+    values = []
+    with torch.no_grad():
+        with tracing.span('weight_update', points=len(steps)):
+            params = perturbation.unflatten(perturbation.stack(steps))
+        batched_forward = vmap(forward, in_dims=(0, None))
+
+        for loader in loaders:
+            sums, total = {}, 0
+            for batch_idx, (inputs, targets) in enumerate(tracing.iterate(loader)):
+                total += inputs.size(0)
+                if use_cuda:
+                    inputs, targets = inputs.cuda(), targets.cuda()
+                with tracing.span('forward', points=len(steps)):
+                    outputs = batched_forward(params, inputs) # K x batch_size x classes
+                with tracing.span('metrics'):
+                    add_sums(sums, metric_sums(criterion, outputs, targets, metrics))
+            with tracing.span('metrics'):
+                values.append(metric_values(sums, total, metrics))
+    return torch.cat(values, 1).tolist()
+
+
+def eval_linear_logits(weight, bias, directions, loader, use_cuda=False):
+    """
+    Compute the logits of the final linear layer and their derivatives along the
+    directions for all samples. When only the final linear layer is perturbed, the
+    logits at coordinates (x, y) are logits[0] + x*logits[1] + y*logits[2].
+
+    Args:
+        weight, bias: the unperturbed parameters of the final linear layer
+        directions: a list of (weight, bias) directions of the final linear layer
+        loader: a loader of the (features, targets) batches at the input of the layer
+        use_cuda: use cuda or not
+    Returns:
+        the logits as a (1 + len(directions)) x num_samples x classes tensor and the
+        targets of all samples
+    """
+    weights = torch.stack([weight] + [dw for dw, db in directions]).float()
+    biases = torch.stack([bias] + [db for dw, db in directions]).float()
+    if use_cuda:
+        weights, biases = weights.cuda(), biases.cuda()
+
+    logits, all_targets = [], []
+    with torch.no_grad():
+        for batch_idx, (inputs, targets) in enumerate(tracing.iterate(loader)):
+            if use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            with tracing.span('forward'):
+                logits.append(torch.einsum('bp,kcp->kbc', inputs, weights) + biases.unsqueeze(1))
+            all_targets.append(targets)
+
+    return torch.cat(logits, 1), torch.cat(all_targets)
+
+
+def eval_metrics_logits(criterion, logits, steps, metrics, chunk_elements=2**25):
+    """
+    Evaluate the metrics at K coordinates from the logits computed by
+    eval_linear_logits, with one batched contraction per chunk of coordinates.
+
+    Args:
+        criterion: loss function
+        logits: a list of (logits, targets) pairs from eval_linear_logits, one per loader
+        steps: K coordinates (x or (x, y)) along the directions
+        metrics: names of the metrics, see METRICS
+        chunk_elements: the maximum number of logits materialized at once
+    Returns:
+        K lists of the values of all metrics for every loader, as in eval_metrics
+    """
+    values = []
+    with torch.no_grad():
+        for loader_logits, targets in logits:
+            steps_tensor = torch.as_tensor(np.asarray(steps, dtype=np.float32).reshape(len(steps), -1),
+                                           device=loader_logits.device)
+            num_samples, num_classes = loader_logits.shape[1], loader_logits.shape[2]
+            chunk = max(1, chunk_elements // (num_samples * num_classes))
+            loader_values = []
+            for start in range(0, len(steps), chunk):
+                with tracing.span('forward', points=len(steps_tensor[start:start + chunk])):
+                    outputs = loader_logits[0] + torch.einsum('kd,dbc->kbc', steps_tensor[start:start + chunk],
+                                                              loader_logits[1:])
+                with tracing.span('metrics'):
+                    loader_values.append(metric_values(metric_sums(criterion, outputs, targets, metrics),
+                                                       num_samples, metrics))
+            values.append(torch.cat(loader_values))
+    return torch.cat(values, 1).tolist()
@@ -0,0 +1,206 @@
+"""
+    A faster evaluation backend for the modified models.
+
+    The forward pass runs under torch.inference_mode, optionally on channels_last
+    inputs and with bfloat16 autocast, and the BatchNorm layers can be folded into
+    the preceding convolution or linear layer. The folded weights are computed from
+    the current parameters in every forward, so the folding follows the perturbation
+    of each grid point. Folding uses the running statistics, i.e., it assumes eval mode.
+
+    The forward can also be compiled with torch.compile as a function of the
+    parameters and states, which are passed as inputs rather than baked into the
+    graph, so it is compiled once per input shape and reused at every grid point.
+"""
+
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.fx
+from torch.func import functional_call
+import evaluation
+
+
+def bn_scale_shift(bias, mean, var, gamma, beta, eps):
+    """ The scale and shift of the eval mode BatchNorm applied to an output with 'bias'. """
+    scale = torch.rsqrt(var + eps)
+    if gamma is not None:
+        scale = scale * gamma
+    shift = -mean * scale if bias is None else (bias - mean) * scale
+    if beta is not None:
+        shift = shift + beta
+    return scale, shift
+
+
+def conv_bn(x, weight, bias, mean, var, gamma, beta, eps, stride, padding, dilation, groups):
+    """ A Conv2d followed by an eval mode BatchNorm2d as a single convolution. """
+    scale, shift = bn_scale_shift(bias, mean, var, gamma, beta, eps)
+    return F.conv2d(x, weight * scale.view(-1, 1, 1, 1), shift, stride, padding, dilation, groups)
+
+
+def linear_bn(x, weight, bias, mean, var, gamma, beta, eps):
+    """ A Linear followed by an eval mode BatchNorm1d as a single linear layer. """
+    scale, shift = bn_scale_shift(bias, mean, var, gamma, beta, eps)
+    return F.linear(x, weight * scale.view(-1, 1), shift)
+
+
+def fold_batchnorm(gm):
+    """
+    Fold every BatchNorm of a traced model that only follows a Conv2d or Linear layer.
+
+    Args:
+        gm: the torch.fx.GraphModule of the neural net model
+    Returns:
+        the number of folded BatchNorm layers
+    """
+    modules = dict(gm.named_modules())
+    graph = gm.graph
+    num_folded = 0
+
+    for node in list(graph.nodes):
+        if node.op != 'call_module' or not isinstance(modules[node.target], (nn.BatchNorm1d, nn.BatchNorm2d)):
+            continue
+        prev = node.args[0]
+        if not isinstance(prev, torch.fx.Node) or prev.op != 'call_module' or len(prev.users) > 1:
+            continue
+        bn, layer = modules[node.target], modules[prev.target]
+        if not bn.track_running_stats:
+            continue
+        if isinstance(bn, nn.BatchNorm2d) and isinstance(layer, nn.Conv2d) and layer.padding_mode == 'zeros':
+            fn, extra = conv_bn, (layer.stride, layer.padding, layer.dilation, layer.groups)
+        elif isinstance(bn, nn.BatchNorm1d) and isinstance(layer, nn.Linear):
+            fn, extra = linear_bn, ()
+        else:
+            continue
+
+        with graph.inserting_before(node):
+            def attr(module_name, module, name):
+                if getattr(module, name) is None:
+                    return None
+                return graph.get_attr('%s.%s' % (module_name, name))
+            args = (prev.args[0], attr(prev.target, layer, 'weight'), attr(prev.target, layer, 'bias'),
+                    attr(node.target, bn, 'running_mean'), attr(node.target, bn, 'running_var'),
+                    attr(node.target, bn, 'weight'), attr(node.target, bn, 'bias'), bn.eps) + extra
+            folded = graph.call_function(fn, args)
+        node.replace_all_uses_with(folded)
+        graph.erase_node(node)
+        graph.erase_node(prev)
+        num_folded += 1
+
+    return num_folded
+
+
+def reshape_views(gm):
+    """ Replace the view calls of a traced model by reshape, which also accepts
+        the channels_last activations.
+    """
+    for node in gm.graph.nodes:
+        if node.op == 'call_method' and node.target == 'view':
+            node.target = 'reshape'
+
+
+def trace(net, channels_last=False, fold_bn=False):
+    """
+    Trace 'net' into a torch.fx.GraphModule prepared for the given options.
+
+    The traced module shares the submodules and thus the parameter and state tensors
+    of 'net' under the same names, so moving the parameters of 'net', or passing them
+    to torch.func.functional_call, applies to the traced model as well.
+
+    Returns:
+        the traced module and the number of folded BatchNorm layers
+    """
+    gm = torch.fx.symbolic_trace(net)
+    num_folded = fold_batchnorm(gm) if fold_bn else 0
+    if channels_last:
+        reshape_views(gm)
+    gm.graph.lint()
+    gm.recompile()
+    return gm, num_folded
+
+
+class FastNet(nn.Module):
+    """
+        Evaluate 'net' under torch.inference_mode, optionally with channels_last
+        inputs, bfloat16 autocast, folded BatchNorm layers and a compiled forward.
+        The outputs are float32.
+        As in prefix_cache.SuffixNet, the children of 'net' are registered under the
+        same names, so the parameter names and the perturbation of 'net' apply unchanged.
+    """
+
+    def __init__(self, net, channels_last=False, bf16=False, fold_bn=False, compile=False):
+        super(FastNet, self).__init__()
+        self.num_folded = 0
+        if channels_last or fold_bn:
+            net, self.num_folded = trace(net, channels_last, fold_bn)
+        for name, module in net.named_children():
+            self.add_module(name, module)
+        self.channels_last = channels_last
+        self.bf16 = bf16
+        # keep 'net' without registering it as a child
+        self.net = [net]
+
+        # the time spent in the first forward of each input shape, i.e., compiling
+        self.compiled = None
+        self.compile_time = 0.0
+        self.compiled_shapes = set()
+        if compile:
+            self.compiled = [torch.compile(self.functional_forward, dynamic=False)]
+
+    def functional_forward(self, x, tensors=None):
+        """ The forward of 'net', with the parameters and states given by 'tensors' if any. """
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            if tensors is None:
+                outputs = self.net[0](x)
+            else:
+                outputs = functional_call(self.net[0], tensors, (x,))
+        return outputs.float()
+
+    def forward(self, x):
+        with torch.inference_mode():
+            if self.compiled is None:
+                return self.functional_forward(x)
+
+            # the current tensors are inputs of the compiled graph, so a perturbation
+            # of the parameters does not trigger a recompilation
+            tensors = dict(self.named_parameters())
+            tensors.update(self.named_buffers())
+            if tuple(x.shape) in self.compiled_shapes:
+                return self.compiled[0](x, tensors)
+            start = time.time()
+            outputs = self.compiled[0](x, tensors)
+            self.compile_time += time.time() - start
+            self.compiled_shapes.add(tuple(x.shape))
+            return outputs
+
+
+def check_accuracy(net, fast_net, perturbation, criterion, loader, steps, metrics, use_cuda=False):
+    """
+    Compare the metrics of 'fast_net' with the float32 reference 'net' at a few points.
+
+    Args:
+        net: the reference model, whose parameters are moved by 'perturbation'
+        fast_net: the FastNet of 'net'
+        perturbation: a net_plotter.FlatPerturbation of 'net'
+        criterion: loss function
+        loader: dataloader
+        steps: the coordinates of the points to compare
+        metrics: names of the metrics, see evaluation.METRICS
+        use_cuda: use cuda or not
+    Returns:
+        the largest absolute difference of each metric over the points. Values that
+        are NaN for both models, e.g., at points where the perturbed states are
+        invalid, are equal, and a NaN of only one of them is an infinite difference.
+    """
+    diffs = np.zeros(len(metrics))
+    for step in steps:
+        perturbation.step(step)
+        ref = np.array(evaluation.eval_metrics(net, criterion, [loader], metrics, use_cuda))
+        fast = np.array(evaluation.eval_metrics(fast_net, criterion, [loader], metrics, use_cuda))
+        diff = np.where(np.isnan(fast) | np.isnan(ref), np.inf, np.abs(fast - ref))
+        diffs = np.maximum(diffs, np.where(np.isnan(fast) & np.isnan(ref), 0.0, diff))
+    perturbation.reset()
+    return diffs
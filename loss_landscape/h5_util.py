@@ -1,8 +1,15 @@
 """
-    Serialization and deserialization of directions in the direction file.
+    Serialization and deserialization of directions in the direction file,
+    and incremental writing of values and completion bitmaps to the surface file.
 """
 
+import os
+import time
+import contextlib
+import h5py
+import numpy as np
 import torch
+import tracing
 
 def write_list(f, name, direction):
     """ Save the direction to the hdf5 file with name as the key
@@ -24,3 +31,232 @@ def read_list(f, name):
     """ Read group with name as the key from the hdf5 file and return a list numpy vectors. """
     grp = f[name]
     return [grp[str(i)] for i in range(len(grp))]
+
+
+class DirectionStore(object):
+    """
+        A direction materialized into one contiguous float32 buffer.
+
+        Indexing and iterating the store returns zero-copy numpy views shaped like
+        the corresponding layer, so it can be used wherever a list of per-layer
+        numpy arrays is expected, e.g., net_plotter.FlatPerturbation.
+    """
+
+    def __init__(self, flat, shapes):
+        self.flat = flat
+        self.shapes = [tuple(s) for s in shapes]
+        self.offsets = np.cumsum([0] + [int(np.prod(s)) for s in self.shapes])
+        assert self.offsets[-1] == flat.size, 'the buffer does not match the layer shapes'
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        return self.flat[self.offsets[i]:self.offsets[i + 1]].reshape(self.shapes[i])
+
+    def __iter__(self):
+        for i in range(len(self.shapes)):
+            yield self[i]
+
+    def tensor(self):
+        """ Return the whole direction as a 1D tensor sharing memory with the buffer. """
+        return torch.from_numpy(self.flat)
+
+
+@contextlib.contextmanager
+def atomic_file(fname):
+    """ Yield the name of a temporary file, which is renamed to fname when the block
+        completes. Concurrent readers, e.g., of a cache shared by the ranks of a node,
+        never see a partial file, and a failed block leaves no file behind.
+    """
+    tmp_file = fname + '.%d.tmp' % os.getpid()
+    try:
+        yield tmp_file
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.replace(tmp_file, fname)
+
+
+def atomic_save(fname, array):
+    """ Save the array as the .npy file fname, see atomic_file. """
+    with atomic_file(fname) as tmp_file:
+        with open(tmp_file, 'wb') as fp:
+            np.save(fp, array)
+
+
+def read_direction(f, name, mmap_file=''):
+    """ Read group with name as the key from the hdf5 file into a DirectionStore.
+
+        Every layer is read from the file exactly once. If mmap_file is given, the
+        buffer is cached as a .npy file and memory mapped (copy-on-write), so that
+        processes on the same node share the pages.
+
+        Args:
+            f: h5py file object
+            name: key of the direction group
+            mmap_file: optional path of the .npy cache
+
+        Returns:
+            a DirectionStore
+    """
+    grp = f[name]
+    dsets = [grp[str(i)] for i in range(len(grp))]
+    shapes = [d.shape for d in dsets]
+
+    if mmap_file and os.path.exists(mmap_file):
+        flat = np.load(mmap_file, mmap_mode='c')
+        if flat.size == sum(int(np.prod(s)) for s in shapes):
+            return DirectionStore(flat, shapes)
+
+    flat = np.empty(sum(int(np.prod(s)) for s in shapes), dtype=np.float32)
+    loc = 0
+    for d in dsets:
+        n = int(np.prod(d.shape))
+        if n > 0:
+            flat[loc:loc + n] = np.asarray(d[()], dtype=np.float32).ravel()
+        loc += n
+
+    if mmap_file:
+        atomic_save(mmap_file, flat)
+        flat = np.load(mmap_file, mmap_mode='c')
+
+    return DirectionStore(flat, shapes)
+
+
+def done_key(key):
+    """ The name of the completion bitmap of the dataset 'key'. """
+    return key + '_done'
+
+
+def read_done(f, key, shape):
+    """ Read the completion map of the dataset 'key', True where a value has been written.
+
+        The bitmap is stored packed, one bit per point in the order of the flat
+        indices, and is created together with the dataset, see
+        SurfaceWriter.create_dataset. Legacy files written without bitmaps fall
+        back to the -1 initial value of the dataset, which only holds for the
+        loss values and max_eig. A missing dataset has no points calculated.
+
+        Returns:
+            a boolean array of the given shape
+    """
+    size = int(np.prod(shape))
+    if done_key(key) in f.keys():
+        packed = f[done_key(key)][:]
+        return np.unpackbits(packed, count=size, bitorder='little').astype(bool).reshape(shape)
+    if key in f.keys():
+        return f[key][:] != -1
+    return np.zeros(shape, dtype=bool)
+
+
+def write_done(f, key, done):
+    """ Overwrite the completion bitmap of the dataset 'key' with the boolean array 'done'. """
+    packed = np.packbits(np.asarray(done, dtype=bool).ravel(), bitorder='little')
+    if done_key(key) in f.keys():
+        f[done_key(key)][...] = packed
+    else:
+        f.create_dataset(done_key(key), data=packed)
+
+
+def set_bits(dset, inds):
+    """ Set the bits of the flat indices 'inds' in a packed bitmap dataset. """
+    byte_inds, inverse = np.unique(inds // 8, return_inverse=True)
+    bits = np.zeros(len(byte_inds), dtype=np.uint8)
+    np.bitwise_or.at(bits, inverse, np.left_shift(1, inds % 8).astype(np.uint8))
+    fspace = dset.id.get_space()
+    fspace.select_elements(byte_inds.reshape(-1, 1))
+    mspace = h5py.h5s.create_simple((len(byte_inds),))
+    packed = np.empty(len(byte_inds), dtype=np.uint8)
+    dset.id.read(mspace, fspace, packed)
+    dset.id.write(mspace, fspace, packed | bits)
+
+
+class SurfaceWriter(object):
+    """
+        Write the values of grid points to the surface file incrementally.
+
+        Results are buffered and written on a count or time budget, touching only
+        the cells that changed, followed by a flush of the file. The written cells
+        are then marked in the completion bitmap of each dataset, see read_done.
+        Cells that have not been flushed are not marked, so they are simply
+        recomputed when a killed job is resumed.
+
+        A dataset may have trailing dimensions after those of the grid, e.g., a
+        vector per point, in which case the value of a record is an array of the
+        trailing shape.
+
+        The timings of the records are summed in compute_time, the compute time of
+        all ranks.
+    """
+
+    def __init__(self, f, keys, flush_every=1, flush_secs=0, shape=None):
+        """
+            Args:
+              f: h5py file object opened for writing
+              keys: the names of the datasets, one per value of a record
+              flush_every: write and flush after this many points
+              flush_secs: write and flush when this many seconds have passed since
+                          the last flush, checked whenever a point is added
+              shape: the shape of the grid, by default the shape of the first dataset
+        """
+        self.f = f
+        self.keys = keys
+        self.shape = tuple(f[keys[0]].shape if shape is None else shape)
+        self.flush_every = max(1, flush_every)
+        self.flush_secs = flush_secs
+        self.pending = []
+        self.last_flush = time.time()
+        self.compute_time = 0.0
+        # the bitmaps of legacy files follow the -1 initial values of the first
+        # dataset, since all values of a record have always been written together
+        missing = [key for key in keys if done_key(key) not in f.keys()]
+        if missing:
+            legacy_done = read_done(f, keys[0], self.shape)
+            for key in missing:
+                write_done(f, key, legacy_done)
+
+    @staticmethod
+    def create_dataset(f, key, data, shape=None):
+        """ Create a chunked dataset, so that writing a few cells only touches their chunks,
+            with an empty completion bitmap of the grid shape, by default the shape of data.
+        """
+        dset = f.create_dataset(key, data=data, chunks=True)
+        write_done(f, key, np.zeros(np.shape(data) if shape is None else shape, dtype=bool))
+        return dset
+
+    def write(self, records):
+        """ Add the records (flat_index, values, timing) and flush if the budget is used up. """
+        self.pending.extend(records)
+        self.compute_time += sum(record[2] for record in records)
+        if len(self.pending) >= self.flush_every or \
+                (self.flush_secs > 0 and time.time() - self.last_flush >= self.flush_secs):
+            self.flush()
+
+    def flush(self):
+        """ Write the pending cells of every dataset and flush the file. """
+        if len(self.pending) == 0:
+            return
+        with tracing.span('hdf5_write', points=len(self.pending)):
+            inds = np.array([record[0] for record in self.pending], dtype=np.int64)
+            for i, key in enumerate(self.keys):
+                dset = self.f[key]
+                values = np.array([record[1][i] for record in self.pending], dtype=dset.dtype)
+                # select only the changed cells in the file, with all of their trailing elements
+                cell_size = int(np.prod(dset.shape[len(self.shape):]))
+                elements = (inds[:, None] * cell_size + np.arange(cell_size)).ravel()
+                fspace = dset.id.get_space()
+                fspace.select_elements(np.stack(np.unravel_index(elements, dset.shape), axis=1))
+                mspace = h5py.h5s.create_simple((len(elements),))
+                dset.id.write(mspace, fspace, values.reshape(-1))
+            # mark the cells only after all of their values are on disk
+            self.f.flush()
+            for key in self.keys:
+                set_bits(self.f[done_key(key)], inds)
+            self.f.flush()
+        self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
@@ -3,7 +3,7 @@ import time
 import numpy as np
 from torch import nn
 from torch.autograd import Variable
-from scipy.sparse.linalg import LinearOperator, eigsh
+from torch.func import functional_call, grad, jvp, vjp, vmap
 
 ################################################################################
 #                              Supporting Functions
@@ -87,13 +87,215 @@ def eval_hess_vec_prod(vec, params, net, criterion, dataloader, use_cuda=False):
         prod.backward()
 
 
+class HessVecProd(object):
+    """
+        Hessian-vector products of the loss over a dataset with torch.func.
+
+        The selected parameters are one flat tensor on the compute device, and each
+        product is the forward-over-reverse jvp(grad(loss)) of a functional forward,
+        accumulated over the batches into a flat tensor. Nothing is written to the
+        .grad of the parameters, and neither the vector nor the result leave the device.
+        The reverse-over-reverse vjp(grad(loss)) is available as well, which may be
+        faster on CPUs. The Hessian is the sum of the Hessians of the mean loss of
+        each batch.
+    """
+
+    def __init__(self, net, criterion, dataloader, use_cuda=False, include_bn=False, mode='fwdrev'):
+        """
+            Args:
+              net: model with trained (or perturbed) parameters, evaluated in eval mode
+              criterion: loss function
+              dataloader: dataloader for the dataset
+              use_cuda: use GPU
+              include_bn: If include_bn, the Hessian also covers the BN parameters and
+                          biases, otherwise only the parameters with dim > 1.
+              mode: 'fwdrev' for jvp(grad) or 'revrev' for vjp(grad)
+        """
+        assert mode in ['fwdrev', 'revrev'], 'unknown Hessian-vector product mode'
+        self.mode = mode
+        if isinstance(net, nn.DataParallel):
+            net = net.module
+        if use_cuda:
+            net.cuda()
+        net.eval()
+        self.net = net
+        self.criterion = criterion
+        self.dataloader = dataloader
+        self.use_cuda = use_cuda
+        self.count = 0 # number of products
+
+        # the tensors that are not differentiated are passed as they are
+        self.tensors = {name: b for name, b in net.named_buffers()}
+        self.names, self.shapes, self.numels, theta = [], [], [], []
+        for name, p in net.named_parameters():
+            if include_bn or len(p.size()) > 1:
+                self.names.append(name)
+                self.shapes.append(p.shape)
+                self.numels.append(p.numel())
+                theta.append(p.detach().reshape(-1))
+            else:
+                self.tensors[name] = p.detach()
+        self.theta = torch.cat(theta)
+        self.size = self.theta.numel()
+
+    def batch_loss(self, theta, inputs, targets):
+        """ The loss of a batch as a function of the flat parameters. """
+        params = dict(self.tensors)
+        for name, shape, t in zip(self.names, self.shapes, torch.split(theta, self.numels)):
+            params[name] = t.view(shape)
+        return self.criterion(functional_call(self.net, params, (inputs,)), targets)
+
+    def __call__(self, vec):
+        """ Return H*vec as a flat tensor on the device of the parameters. """
+        self.count += 1
+        vec = vec.to(self.theta)
+        hv = torch.zeros_like(self.theta)
+        for batch_idx, (inputs, targets) in enumerate(self.dataloader):
+            if self.use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            batch_grad = lambda theta: grad(self.batch_loss)(theta, inputs, targets)
+            if self.mode == 'fwdrev':
+                _, batch_hv = jvp(batch_grad, (self.theta,), (vec,))
+            else:
+                _, batch_vjp = vjp(batch_grad, self.theta)
+                batch_hv, = batch_vjp(vec)
+            hv += batch_hv
+        return hv
+
+    def matmat(self, V):
+        """ Return H*V for the rows of V, with a single pass over the data for all rows. """
+        self.count += len(V)
+        V = V.to(self.theta)
+        HV = torch.zeros_like(V)
+        for batch_idx, (inputs, targets) in enumerate(self.dataloader):
+            if self.use_cuda:
+                inputs, targets = inputs.cuda(), targets.cuda()
+            batch_grad = lambda theta: grad(self.batch_loss)(theta, inputs, targets)
+            if self.mode == 'fwdrev':
+                HV += vmap(lambda v: jvp(batch_grad, (self.theta,), (v,))[1])(V)
+            else:
+                _, batch_vjp = vjp(batch_grad, self.theta)
+                HV += vmap(batch_vjp)(V)[0]
+        return HV
+
+
 ################################################################################
 #                  For computing Eigenvalues of Hessian
 ################################################################################
-def min_max_hessian_eigs(net, dataloader, criterion, rank=0, use_cuda=False, verbose=False):
+def lanczos(matvec, v0, k=1, tol=1e-2, max_iter=100, callback=None, return_vectors=False, min_iter=20,
+            ncv=20):
+    """
+    Compute the k largest and the k smallest eigenvalues of a symmetric operator
+    from a single Krylov sequence, with the thick-restart Lanczos iteration and full
+    reorthogonalization. The vectors stay on the device of v0, only the small
+    projected matrix is solved on the CPU in float64.
+
+    At most ncv + 1 vectors of the size of v0 are kept, as with ncv of scipy's
+    eigsh, whatever max_iter is: when the basis is full, it is restarted from the
+    Ritz vectors of the ncv // 4 (at least k) outermost Ritz values at each end.
+
+    Each wanted Ritz value theta_i is checked relative to itself, since the two ends
+    of a Hessian spectrum differ by orders of magnitude: its residual norm
+    |beta_m * s_m| and its change since the previous iteration must both be below
+    tol * |theta_i|, with a floor of 1e-2 * tol times the largest magnitude of the
+    Ritz values for eigenvalues near zero. The small end of the spectrum appears
+    late in the Krylov sequence, so at least min_iter matvecs are done.
+
+    Args:
+        matvec: a function computing A*v for a flat tensor v
+        v0: the starting vector
+        k: number of eigenvalues at each end of the spectrum
+        tol: the relative tolerance
+        max_iter: the maximum number of matvecs
+        callback: called with the iteration number after every matvec, or None
+        return_vectors: also return the Ritz vectors of the eigenvalues
+        min_iter: the minimum number of matvecs
+        ncv: the maximum number of Lanczos vectors, which bounds the memory
+
+    Returns:
+        top: the k largest eigenvalues in descending order
+        bottom: the k smallest eigenvalues in ascending order
+        count: the number of matvecs
+        vectors: if return_vectors, the unit Ritz vectors of top and bottom as rows
+    """
+    # with restarts, the number of matvecs is not bounded by the dimension
+    min_iter = min(max(min_iter, 2 * k), max_iter)
+    ncv = min(max(ncv, 4 * k + 2), v0.numel())
+    keep = max(k, ncv // 4)
+    Q = torch.empty((ncv + 1, v0.numel()), dtype=v0.dtype, device=v0.device)
+    Q[0] = v0 / v0.norm()
+    # the projection Q^T A Q, tridiagonal except for the coupling of the kept Ritz vectors after a restart
+    T = np.zeros((ncv, ncv))
+    p = 0 # the index of the current vector in the basis
+    prev = None # the wanted Ritz values of the previous iteration
+    for j in range(max_iter):
+        w = matvec(Q[p])
+        if callback is not None:
+            callback(j + 1)
+        # full reorthogonalization against the basis, twice for numerical stability,
+        # the coefficients of the first pass are the column of T
+        h = Q[:p + 1] @ w
+        w = w - h @ Q[:p + 1]
+        w -= (Q[:p + 1] @ w) @ Q[:p + 1]
+        beta = w.norm().item()
+        T[:p + 1, p] = T[p, :p + 1] = h.double().cpu().numpy()
+
+        theta, S = np.linalg.eigh(T[:p + 1, :p + 1])
+        resid = np.abs(beta * S[-1, :])
+        m = len(theta)
+        ends = np.r_[theta[:k], theta[::-1][:k]]
+        if m >= 2 * k:
+            bound = tol * np.maximum(np.abs(ends), 1e-2 * np.abs(theta).max())
+            converged = j + 1 >= min_iter and prev is not None and \
+                        np.all(np.r_[resid[:k], resid[::-1][:k]] <= bound) and \
+                        np.all(np.abs(ends - prev) <= bound)
+            prev = ends
+        else:
+            converged = False
+        # an invariant subspace has been found if beta vanishes
+        if converged or beta <= 1e-10 * np.abs(theta).max() or j == max_iter - 1:
+            break
+        if p + 1 == ncv:
+            # restart from the outermost Ritz vectors, coupled to the next vector by beta * s_m
+            kept = np.r_[np.arange(keep), np.arange(m - keep, m)]
+            Q[:len(kept)] = torch.as_tensor(S[:, kept].T).to(Q) @ Q[:m]
+            T[:] = 0
+            T[np.arange(len(kept)), np.arange(len(kept))] = theta[kept]
+            T[len(kept), :len(kept)] = T[:len(kept), len(kept)] = beta * S[-1, kept]
+            p = len(kept)
+        else:
+            T[p + 1, p] = T[p, p + 1] = beta
+            p += 1
+        Q[p] = w / beta
+
+    top, bottom = theta[::-1][:k], theta[:k]
+    if not return_vectors:
+        return top, bottom, j + 1
+    wanted = np.r_[np.arange(m - 1, m - 1 - len(top), -1), np.arange(len(bottom))]
+    S = torch.as_tensor(S[:, wanted]).to(v0)
+    return top, bottom, j + 1, S.t() @ Q[:m]
+
+
+def warm_start_vector(vectors, mix=0.1, seed=0):
+    """
+    A Lanczos starting vector from the Ritz vectors of a nearby point, e.g., of the
+    neighboring grid point. A random component of relative size 'mix' is added, so
+    that the Krylov sequence still finds eigenvectors that become dominant.
+    """
+    v0 = vectors.sum(0)
+    noise = torch.randn(v0.numel(), generator=torch.Generator().manual_seed(int(seed))).to(v0)
+    return v0 / v0.norm() + mix * noise / noise.norm()
+
+
+def min_max_hessian_eigs(net, dataloader, criterion, rank=0, use_cuda=False, verbose=False, hvp_mode='fwdrev',
+                         k=1, tol=1e-2, max_iter=100, v0=None, return_vectors=False, min_iter=20,
+                         ncv=20):
     """
         Compute the largest and the smallest eigenvalues of the Hessian marix.
 
+        Both ends of the spectrum are taken from a single Lanczos run, with
+        Hessian-vector products that stay on the device.
+
         Args:
             net: the trained model.
             dataloader: dataloader for the dataset, may use a subset of it.
@@ -101,48 +303,140 @@ def min_max_hessian_eigs(net, dataloader, criterion, rank=0, use_cuda=False, ver
             rank: rank of the working node.
             use_cuda: use GPU
             verbose: print more information
+            hvp_mode: 'fwdrev' or 'revrev', see HessVecProd
+            k: number of eigenvalues resolved at each end of the spectrum, see lanczos
+            tol: the relative tolerance of the eigenvalues, see lanczos
+            max_iter: the maximum number of Hessian-vector products
+            v0: the starting vector, e.g., from warm_start_vector, or None for a
+                fixed random vector
+            return_vectors: also return the Ritz vectors, see lanczos
+            min_iter: the minimum number of Hessian-vector products, see lanczos
+            ncv: the maximum number of Lanczos vectors of the size of the model, see lanczos
 
         Returns:
             maxeig: max eigenvalue
             mineig: min eigenvalue
-            hess_vec_prod.count: number of iterations for calculating max and min eigenvalues
+            hvp.count: number of iterations for calculating max and min eigenvalues
+            vectors: if return_vectors, the Ritz vectors of the k largest and the k
+                     smallest eigenvalues
     """
 
-    params = [p for p in net.parameters() if len(p.size()) > 1]
-    N = sum(p.numel() for p in params)
+    hvp = HessVecProd(net, criterion, dataloader, use_cuda, mode=hvp_mode)
+
+    start_time = [time.time()]
+    def report(count):
+        if verbose and rank == 0: print("   Iter: %d  time: %f" % (count, time.time() - start_time[0]))
+        start_time[0] = time.time()
+
+    if verbose and rank == 0: print("Rank %d: computing max and min eigenvalues" % rank)
+    if v0 is None:
+        # a fixed starting vector, so that every point and rank starts alike
+        v0 = torch.randn(hvp.size, generator=torch.Generator().manual_seed(0))
+    results = lanczos(hvp, v0.to(hvp.theta), k, tol, max_iter, report, return_vectors, min_iter, ncv)
+    maxeig, mineig = results[0][0], results[1][0]
+    if verbose and rank == 0: print('max eigenvalue = %f  min eigenvalue = %f' % (maxeig, mineig))
 
-    def hess_vec_prod(vec):
-        hess_vec_prod.count += 1  # simulates a static variable
-        vec = npvec_to_tensorlist(vec, params)
-        start_time = time.time()
-        eval_hess_vec_prod(vec, params, net, criterion, dataloader, use_cuda)
-        prod_time = time.time() - start_time
-        if verbose and rank == 0: print("   Iter: %d  time: %f" % (hess_vec_prod.count, prod_time))
-        return gradtensor_to_npvec(net)
+    if return_vectors:
+        return maxeig, mineig, hvp.count, results[3]
+    return maxeig, mineig, hvp.count
 
-    hess_vec_prod.count = 0
-    if verbose and rank == 0: print("Rank %d: computing max eigenvalue" % rank)
 
-    A = LinearOperator((N, N), matvec=hess_vec_prod)
-    eigvals, eigvecs = eigsh(A, k=1, tol=1e-2)
-    maxeig = eigvals[0]
-    if verbose and rank == 0: print('max eigenvalue = %f' % maxeig)
+################################################################################
+#                 For the trace and the spectral density of Hessian
+################################################################################
+def rademacher(num_probes, size, generator):
+    """ Random vectors with independent +1/-1 entries as the rows of a tensor. """
+    return torch.randint(0, 2, (num_probes, size), generator=generator).float() * 2 - 1
+
 
-    # If the largest eigenvalue is positive, shift matrix so that any negative eigenvalue is now the largest
-    # We assume the smallest eigenvalue is zero or less, and so this shift is more than what we need
-    shift = maxeig*.51
-    def shifted_hess_vec_prod(vec):
-        return hess_vec_prod(vec) - shift*vec
+def hutchinson_trace(hvp, num_probes=16, probe_batch=4, seed=0):
+    """
+    Estimate the trace of the Hessian as the mean of v'Hv over Rademacher probes v.
+    The probes of a batch share one pass over the data, see HessVecProd.matmat.
 
-    if verbose and rank == 0: print("Rank %d: Computing shifted eigenvalue" % rank)
+    Args:
+        hvp: a HessVecProd
+        num_probes: the number of probe vectors
+        probe_batch: the number of probes per pass over the data
+        seed: the seed of the probes, the same probes are used at every point
 
-    A = LinearOperator((N, N), matvec=shifted_hess_vec_prod)
-    eigvals, eigvecs = eigsh(A, k=1, tol=1e-2)
-    eigvals = eigvals + shift
-    mineig = eigvals[0]
-    if verbose and rank == 0: print('min eigenvalue = ' + str(mineig))
+    Returns:
+        the trace estimate and its standard error
+    """
+    generator = torch.Generator().manual_seed(seed)
+    estimates = []
+    for start in range(0, num_probes, probe_batch):
+        V = rademacher(min(probe_batch, num_probes - start), hvp.size, generator).to(hvp.theta)
+        estimates.append((V * hvp.matmat(V)).sum(1).cpu())
+    estimates = torch.cat(estimates).double().numpy()
+    stderr = estimates.std(ddof=1) / np.sqrt(num_probes) if num_probes > 1 else 0.0
+    return estimates.mean(), stderr
 
-    if maxeig <= 0 and mineig > 0:
-        maxeig, mineig = mineig, maxeig
 
-    return maxeig, mineig, hess_vec_prod.count
+def slq(hvp, num_probes=4, steps=30, probe_batch=4, seed=0):
+    """
+    Stochastic Lanczos quadrature of the eigenvalue density of the Hessian.
+
+    A Lanczos run of 'steps' products from a normalized Rademacher probe gives a
+    Gauss quadrature of the spectral measure seen by the probe: the eigenvalues of
+    the tridiagonal matrix are the nodes and the squared first components of its
+    eigenvectors the weights. The density is the average of the quadratures of the
+    probes, see slq_density. The Lanczos runs of a batch of probes advance together,
+    with one pass over the data per step, and are fully reorthogonalized, which keeps
+    steps x probe_batch vectors of the size of the parameters.
+
+    Args:
+        hvp: a HessVecProd
+        num_probes: the number of probe vectors
+        steps: the number of Lanczos steps per probe
+        probe_batch: the number of probes per pass over the data
+        seed: the seed of the probes, the same probes are used at every point
+
+    Returns:
+        nodes and weights, num_probes x steps arrays, where the weights of each probe
+        sum up to 1. A run that ends early, i.e., in an invariant subspace, is padded
+        with zero weights.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    steps = min(steps, hvp.size)
+    nodes, weights = np.zeros((num_probes, steps)), np.zeros((num_probes, steps))
+    for start in range(0, num_probes, probe_batch):
+        V = rademacher(min(probe_batch, num_probes - start), hvp.size, generator).to(hvp.theta)
+        Q = torch.empty((steps,) + V.shape, dtype=V.dtype, device=V.device)
+        Q[0] = V / V.norm(dim=1, keepdim=True)
+        alphas, betas = [], []
+        for j in range(steps):
+            W = hvp.matmat(Q[j])
+            alphas.append((W * Q[j]).sum(1))
+            if j == steps - 1:
+                break
+            # the three-term recurrence as a full Gram-Schmidt against all previous vectors
+            basis = Q[:j + 1]
+            W = W - torch.einsum('jb,jbn->bn', torch.einsum('jbn,bn->jb', basis, W), basis)
+            W = W - torch.einsum('jb,jbn->bn', torch.einsum('jbn,bn->jb', basis, W), basis)
+            beta = W.norm(dim=1)
+            betas.append(beta)
+            Q[j + 1] = W / beta.clamp_min(torch.finfo(W.dtype).tiny)[:, None]
+
+        alphas = torch.stack(alphas).double().cpu().numpy()
+        betas = torch.stack(betas).double().cpu().numpy() if betas else np.zeros((0, len(V)))
+        for b in range(len(V)):
+            # stop each run at its first vanishing beta
+            small = np.flatnonzero(betas[:, b] <= 1e-8 * np.abs(alphas[:, b]).max())
+            m = small[0] + 1 if len(small) else len(alphas)
+            T = np.diag(alphas[:m, b]) + np.diag(betas[:m - 1, b], 1) + np.diag(betas[:m - 1, b], -1)
+            theta, S = np.linalg.eigh(T)
+            nodes[start + b, :m], weights[start + b, :m] = theta, S[0] ** 2
+    return nodes, weights
+
+
+def slq_density(nodes, weights, grid, sigma):
+    """
+    The eigenvalue density of the quadratures from slq, smoothed with a Gaussian of
+    width sigma, at the eigenvalues 'grid'. The last axis of the nodes and weights
+    holds the quadratures of all probes, e.g., the flattened output of slq, and the
+    leading axes, e.g., of the surface, are kept. See plot_1D.plot_1d_eig_density.
+    """
+    nodes, weights = np.asarray(nodes), np.asarray(weights)
+    kernel = np.exp(-(np.asarray(grid) - nodes[..., None]) ** 2 / (2 * sigma ** 2)) / (np.sqrt(2 * np.pi) * sigma)
+    return (weights[..., None] * kernel).sum(-2) / weights.sum(-1)[..., None]
@@ -32,7 +32,7 @@ def allreduce_max(comm, array, display_info=False):
         return array
     array = np.asarray(array, dtype='d')
     total = np.zeros_like(array)
-    float_min = np.finfo(np.float).min
+    float_min = np.finfo(np.float64).min
     total.fill(float_min)
 
     if display_info:
@@ -49,7 +49,7 @@ def allreduce_min(comm, array, display_info=False):
         return array
     array = np.asarray(array, dtype='d')
     total = np.zeros_like(array)
-    float_max = np.finfo(np.float).max
+    float_max = np.finfo(np.float64).max
     total.fill(float_max)
 
     if display_info:
@@ -67,7 +67,7 @@ def reduce_max(comm, array, display_info=False):
         return array
     array = np.asarray(array, dtype='d')
     total = np.zeros_like(array)
-    float_min = np.finfo(np.float).min
+    float_min = np.finfo(np.float64).min
     total.fill(float_min)
 
     if display_info:
@@ -84,7 +84,7 @@ def reduce_min(comm, array, display_info=False):
         return array
     array = np.asarray(array, dtype='d')
     total = np.zeros_like(array)
-    float_max = np.finfo(np.float).max
+    float_max = np.finfo(np.float64).max
     total.fill(float_max)
 
     if display_info:
@@ -96,6 +96,67 @@ def reduce_min(comm, array, display_info=False):
     comm.Reduce(array, total, op=mpi4py.MPI.MIN, root=0)
     return total
 
+class ResultStream(object):
+    """
+    Stream compact (flat_index, values, timing) records from all ranks to rank 0
+    with nonblocking sends, instead of reducing the whole result arrays after
+    every point. The ranks are never coupled in lockstep, and rank 0 picks up
+    the records whenever it is ready to store them.
+    """
+
+    TAG = 21
+
+    def __init__(self, comm):
+        self.rank = get_rank(comm) if comm else 0
+        self.nproc = get_num_procs(comm) if comm else 1
+        # use a separate communicator so the records never mix with other messages
+        self.comm = comm.Dup() if comm and self.nproc > 1 else None
+        self.requests = []
+        self.closed = 0 # number of ranks that sent their end marker
+
+    def send(self, record):
+        """ Send a record to rank 0 (non-root ranks only). """
+        self.requests.append(self.comm.isend(record, dest=0, tag=self.TAG))
+        # drop the requests that have completed
+        if len(self.requests) > 64:
+            self.requests = [r for r in self.requests if not r.Test()]
+
+    def receive(self, block=False):
+        """ Receive the records that have arrived at rank 0 so far, or all of them if block. """
+        records = []
+        if self.comm is None:
+            return records
+        while self.closed < self.nproc - 1:
+            if not block and not self.comm.Iprobe(source=mpi4py.MPI.ANY_SOURCE, tag=self.TAG):
+                break
+            record = self.comm.recv(source=mpi4py.MPI.ANY_SOURCE, tag=self.TAG)
+            if record is None:
+                self.closed += 1
+            else:
+                records.append(record)
+        return records
+
+    def close(self):
+        """ Finish the stream. Rank 0 returns the remaining records of all ranks. """
+        records = []
+        if self.comm is None:
+            return records
+        if self.rank == 0:
+            records = self.receive(block=True)
+        else:
+            self.send(None)
+            mpi4py.MPI.Request.Waitall(self.requests)
+        self.comm.Free()
+        self.comm = None
+        return records
+
+
+def gather(comm, obj):
+    """ Gather a picklable object of every rank on rank 0, None on the other ranks. """
+    if not comm:
+        return [obj]
+    return comm.gather(obj, root=0)
+
 def barrier(comm):
     if not comm:
         return
@@ -3,9 +3,10 @@
 """
 
 import torch
-import copy
+import numpy as np
 from os.path import exists, commonprefix
 import h5py
+import hashlib
 import h5_util
 import model_loader
 import os
@@ -18,51 +19,144 @@ def get_weights(net):
     return [p.data for p in net.parameters()]
 
 
+def get_state_targets(net):
+    """
+        Map the keys of the net's state_dict to the tensors that hold them, i.e.,
+        the parameters and the BN buffers, so that states can be updated in place.
+        The mapping is cached on the net and rebuilt only when the net has been
+        moved to another device or dtype, which replaces its buffers.
+    """
+    p = next(iter(net.parameters()))
+    cached = getattr(net, 'state_targets', None)
+    if cached is None or cached[0] != (p.device, p.dtype):
+        net.state_targets = ((p.device, p.dtype), net.state_dict(keep_vars=True))
+    return net.state_targets[1]
+
+
 def set_weights(net, weights, directions=None, step=None):
     """
         Overwrite the network's weights with a specified list of tensors
         or change weights along directions with a step size.
+        Moving along directions goes through get_perturbation, which re-points the
+        parameters into a flat buffer; use its step directly for many points.
     """
     if directions is None:
         # You cannot specify a step length without a direction.
-        for (p, w) in zip(net.parameters(), weights):
-            p.data.copy_(w.type(type(p.data)))
+        with torch.no_grad():
+            for (p, w) in zip(net.parameters(), weights):
+                p.copy_(torch.as_tensor(w).to(p))
     else:
         assert step is not None, 'If a direction is specified then step must be specified as well'
-
-        if len(directions) == 2:
-            dx = directions[0]
-            dy = directions[1]
-            changes = [d0*step[0] + d1*step[1] for (d0, d1) in zip(dx, dy)]
-        else:
-            changes = [d*step for d in directions[0]]
-
-        for (p, w, d) in zip(net.parameters(), weights, changes):
-            p.data = w + torch.Tensor(d).type(type(w))
+        get_perturbation(net, weights, None, directions, 'weights').step(step)
 
 
 def set_states(net, states, directions=None, step=None):
     """
-        Overwrite the network's state_dict or change it along directions with a step size.
+        Overwrite the network's state_dict or change it along directions with a step size,
+        in place, see set_weights. Integer buffers, e.g., BN's num_batches_tracked,
+        are skipped when moving along directions.
     """
     if directions is None:
-        net.load_state_dict(states)
+        targets = get_state_targets(net)
+        assert len(targets) == len(states)
+        with torch.no_grad():
+            for k, t in targets.items():
+                t.copy_(states[k])
     else:
         assert step is not None, 'If direction is provided then the step must be specified as well'
-        if len(directions) == 2:
-            dx = directions[0]
-            dy = directions[1]
-            changes = [d0*step[0] + d1*step[1] for (d0, d1) in zip(dx, dy)]
-        else:
-            changes = [d*step for d in directions[0]]
+        get_perturbation(net, None, states, directions, 'states').step(step)
+
+
+class FlatPerturbation(object):
+    """
+        Move a list of tensors in place along the direction(s) with a step size.
 
-        new_states = copy.deepcopy(states)
-        assert (len(new_states) == len(changes))
-        for (k, v), d in zip(new_states.items(), changes):
-            d = torch.tensor(d)
-            v.add_(d.type(v.type()))
+        The targets (parameters or state tensors) are re-pointed once into one
+        contiguous buffer, and their base values and the directions are flattened
+        into contiguous buffers as well. Every step is then a single fused addmv,
+        flat = base + directions^T * step, without any per-point allocation.
+    """
 
-        net.load_state_dict(new_states)
+    def __init__(self, targets, base, directions, names=None):
+        """
+            Args:
+              targets: a list of tensors to be updated in place, e.g., net.parameters()
+              base: a list of tensors with the base values of the targets
+              directions: a list of one or two directions, each of them a list of
+                          arrays or tensors with one entry per target
+              names: (optional) the names of the targets in the net
+        """
+        self.targets = list(targets)
+        self.names = names
+        assert len(self.targets) == len(base)
+        for direction in directions:
+            assert len(direction) == len(self.targets)
+
+        device, dtype = self.targets[0].device, self.targets[0].dtype
+        self.numels = [t.numel() for t in self.targets]
+        self.base = torch.cat([b.reshape(-1) for b in base]).to(device=device, dtype=dtype)
+        self.directions = torch.stack([self.flatten(d) for d in directions]).to(device=device, dtype=dtype)
+        self.step_buf = torch.zeros(len(directions), device=device, dtype=dtype)
+
+        # re-point the targets into one flat buffer, which keeps the parameter identity
+        self.flat = self.base.clone()
+        offset = 0
+        for t, n in zip(self.targets, self.numels):
+            t.data = self.flat[offset:offset + n].view_as(t)
+            offset += n
+
+    @staticmethod
+    def flatten(direction):
+        """ Concatenate a direction given as a list of arrays/tensors into one 1D tensor. """
+        if isinstance(direction, h5_util.DirectionStore):
+            return direction.tensor()
+        return torch.cat([torch.as_tensor(np.asarray(d, dtype=np.float32)).reshape(-1)
+                          for d in direction])
+
+    def step(self, step):
+        """ Overwrite the targets with base + x*dx (+ y*dy) in place. """
+        step = np.atleast_1d(step)
+        assert len(step) == len(self.step_buf), 'The step does not match the number of directions'
+        for i, s in enumerate(step):
+            self.step_buf[i] = float(s)
+        torch.addmv(self.base, self.directions.t(), self.step_buf, out=self.flat)
+
+    def reset(self):
+        """ Restore the base values of the targets. """
+        self.flat.copy_(self.base)
+
+    def stack(self, steps):
+        """ Return a (K, numel) tensor with base + directions^T * step for each of the K steps. """
+        steps = np.asarray(steps, dtype=np.float64).reshape(len(steps), -1)
+        steps = torch.as_tensor(steps).to(device=self.base.device, dtype=self.base.dtype)
+        return torch.addmm(self.base, steps, self.directions)
+
+    def unflatten(self, stacked):
+        """ Split a stacked (K, numel) tensor into a dict of per-target views of shape (K, *shape). """
+        params, offset = {}, 0
+        for name, t, n in zip(self.names, self.targets, self.numels):
+            params[name] = stacked[:, offset:offset + n].view((stacked.size(0),) + tuple(t.shape))
+            offset += n
+        return params
+
+
+def get_perturbation(net, weights, states, directions, dir_type='weights'):
+    """
+        Setup a FlatPerturbation that moves the weights or states of the net along
+        the directions. Non-floating states (e.g., BN's num_batches_tracked) are
+        left untouched.
+    """
+    if dir_type == 'weights':
+        names = [k for k, p in net.named_parameters()]
+        return FlatPerturbation(list(net.parameters()), weights, directions, names)
+    elif dir_type == 'states':
+        targets = get_state_targets(net)
+        inds = [i for i, v in enumerate(targets.values()) if v.is_floating_point()]
+        keys = [k for k in targets.keys()]
+        base = [v for v in states.values()]
+        directions = [[direction[i] for i in inds] for direction in directions]
+        return FlatPerturbation([targets[keys[i]] for i in inds], [base[i] for i in inds],
+                                directions, [keys[i] for i in inds])
 
 
 def get_random_weights(weights):
@@ -327,15 +421,32 @@ def name_direction_file(args):
     return dir_file
 
 
-def load_directions(dir_file):
-    """ Load direction(s) from the direction file."""
+def load_directions(dir_file, cache_dir=''):
+    """ Load direction(s) from the direction file.
+
+        Each direction is read once into a contiguous float32 buffer (DirectionStore)
+        instead of keeping lazy h5py handles that hit the file at every grid point.
+        If cache_dir is given, the buffers are cached there as memory-mapped .npy files.
+        The cache is named by the absolute path, the size and the modification time
+        of the direction file, so that neither another direction file of the same
+        name nor a regenerated one reuses stale directions.
+    """
+    stat = os.stat(dir_file)
+    version = hashlib.sha1(('%s:%d:%d' % (os.path.abspath(dir_file), stat.st_size,
+                                          stat.st_mtime_ns)).encode()).hexdigest()[:16]
+
+    def cache_file(name):
+        if not cache_dir:
+            return ''
+        return os.path.join(cache_dir, '%s_%s_%s.npy' % (os.path.basename(dir_file), version, name))
 
     f = h5py.File(dir_file, 'r')
     if 'ydirection' in f.keys():  # If this is a 2D plot
-        xdirection = h5_util.read_list(f, 'xdirection')
-        ydirection = h5_util.read_list(f, 'ydirection')
+        xdirection = h5_util.read_direction(f, 'xdirection', cache_file('xdirection'))
+        ydirection = h5_util.read_direction(f, 'ydirection', cache_file('ydirection'))
         directions = [xdirection, ydirection]
     else:
-        directions = [h5_util.read_list(f, 'xdirection')]
+        directions = [h5_util.read_direction(f, 'xdirection', cache_file('xdirection'))]
+    f.close()
 
     return directions
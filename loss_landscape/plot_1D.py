@@ -6,6 +6,7 @@ from matplotlib import pyplot as pp
 import h5py
 import argparse
 import numpy as np
+import hess_vec_prod
 
 def plot_1d_loss_err(surf_file, xmin=-1.0, xmax=1.0, loss_max=5, log=False, show=False):
     print('------------------------------------------------------------------')
@@ -148,6 +149,38 @@ def plot_1d_eig_ratio(surf_file, xmin=-1.0, xmax=1.0, val_1='min_eig', val_2='ma
     if show: pp.show()
 
 
+def plot_1d_eig_density(surf_file, xmin=-1.0, xmax=1.0, num_eigs=200, show=False):
+    """
+    Plot the eigenvalue density of the Hessian along x, from the stochastic Lanczos
+    quadratures stored as slq_nodes/slq_weights, see hess_vec_prod.slq_density.
+    Of a 2D surface the row at the y coordinate closest to 0 is plotted.
+    """
+    print('------------------------------------------------------------------')
+    print('plot_1d_eig_density')
+    print('------------------------------------------------------------------')
+
+    f = h5py.File(surf_file,'r')
+    x = f['xcoordinates'][:]
+    nodes = np.array(f['slq_nodes'][:])
+    weights = np.array(f['slq_weights'][:])
+    if 'ycoordinates' in f.keys():
+        row = np.abs(f['ycoordinates'][:]).argmin()
+        nodes, weights = nodes[row], weights[row]
+    f.close()
+
+    # the points that are not calculated yet are NaN, the padding has zero weights
+    used = (weights > 0) & np.isfinite(nodes)
+    eigs = np.linspace(nodes[used].min(), nodes[used].max(), num_eigs)
+    sigma = (eigs[-1] - eigs[0]) / num_eigs
+    density = hess_vec_prod.slq_density(nodes, weights, eigs, max(sigma, 1e-8))
+
+    pp.pcolormesh(x, eigs, np.log10(np.maximum(density, 1e-8)).T, shading='nearest')
+    pp.colorbar(label='log10 density')
+    pp.xlim(xmin, xmax)
+    pp.ylabel('eigenvalue')
+    pp.savefig(surf_file + '_1d_eig_density.pdf', dpi=300, bbox_inches='tight', format='pdf')
+    if show: pp.show()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Plott 1D loss and error curves')
@@ -10,6 +10,8 @@ import argparse
 import numpy as np
 from os.path import exists
 import seaborn as sns
+import adaptive
+import h5_util
 
 
 def plot_2d_contour(surf_file, surf_name='train_loss', vmin=0.1, vmax=10, vlevel=0.5, show=False):
@@ -78,6 +80,34 @@ def plot_2d_contour(surf_file, surf_name='train_loss', vmin=0.1, vmax=10, vlevel
     if show: plt.show()
 
 
+def plot_2d_preview(surf_file, surf_name='train_loss', vmin=0.1, vmax=10, vlevel=0.5, show=False):
+    """Plot the 2D contour map of a partially calculated surface, interpolating the
+       points that are not calculated yet according to the completion bitmap."""
+
+    f = h5py.File(surf_file, 'r')
+    x = np.array(f['xcoordinates'][:])
+    y = np.array(f['ycoordinates'][:])
+    Z = np.array(f[surf_name][:], dtype=float)
+    done = h5_util.read_done(f, surf_name, Z.shape)
+    f.close()
+    X, Y = np.meshgrid(x, y)
+
+    print('%s: %d of %d points calculated (%.1f%%)' % (surf_name, done.sum(), Z.size, 100.0 * done.mean()))
+    if done.sum() < 3:
+        print('Not enough points calculated for a preview')
+        return
+    Z[~done] = np.nan
+    Z = adaptive.interpolate(Z)
+
+    fig = plt.figure()
+    CS = plt.contourf(X, Y, Z, cmap='summer', levels=np.arange(vmin, vmax, vlevel))
+    plt.plot(X[done], Y[done], 'k.', markersize=1)
+    plt.title('%d of %d points' % (done.sum(), Z.size))
+    fig.savefig(surf_file + '_' + surf_name + '_2dpreview' + '.pdf', dpi=300,
+                bbox_inches='tight', format='pdf')
+    if show: plt.show()
+
+
 def plot_trajectory(proj_file, dir_file, show=False):
     """ Plot optimization trajectory on the plane spanned by given directions."""
 
@@ -193,10 +223,13 @@ if __name__ == '__main__':
     parser.add_argument('--vlevel', default=0.5, type=float, help='plot contours every vlevel')
     parser.add_argument('--zlim', default=10, type=float, help='Maximum loss value to show')
     parser.add_argument('--show', action='store_true', default=False, help='show plots')
+    parser.add_argument('--preview', action='store_true', default=False, help='preview a partially calculated surface')
 
     args = parser.parse_args()
 
-    if exists(args.surf_file) and exists(args.proj_file) and exists(args.dir_file):
+    if args.preview and exists(args.surf_file):
+        plot_2d_preview(args.surf_file, args.surf_name, args.vmin, args.vmax, args.vlevel, args.show)
+    elif exists(args.surf_file) and exists(args.proj_file) and exists(args.dir_file):
         plot_contour_trajectory(args.surf_file, args.dir_file, args.proj_file,
                                 args.surf_name, args.vmin, args.vmax, args.vlevel, args.show)
     elif exists(args.proj_file) and exists(args.dir_file):
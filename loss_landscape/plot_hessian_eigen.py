@@ -1,8 +1,10 @@
 """
-    Calculate the hessian matrix of the projected surface and their eigen values.
+    Calculate the hessian matrix of the projected surface and their eigen values,
+    and optionally its trace and eigenvalue density.
 """
 
 import argparse
+import collections
 import copy
 import numpy as np
 import h5py
@@ -22,86 +24,224 @@ import model_loader
 import scheduler
 import projection as proj
 import hess_vec_prod
+import h5_util
 from plot_surface import name_surface_file, setup_surface_file
 
 
+def subsample(loader, ind, repeat, args):
+    """
+        The fixed subsample of --hess_batches batches for one eigensolve of the point
+        'ind'. The subsample is seeded by the point and the repeat, or by the repeat
+        only with --hess_shared, so that every grid point sees the same subsamples.
+    """
+    entropy = [args.hess_seed, repeat] if args.hess_shared else [args.hess_seed, int(ind), repeat]
+    seed = int(np.random.SeedSequence(entropy).generate_state(1)[0])
+    return dataloader.subsample_batches(loader, args.hess_batches, seed)
+
+
+def write_records(writers, records):
+    """
+        Write the records (flat_index, values, timing) of crunch_hessian_eigs, whose
+        values hold a tuple per quantity, or None where it was not calculated. Each
+        quantity has its own writer, so only the calculated datasets are marked.
+    """
+    for i, writer in enumerate(writers):
+        writer.write([(ind, values[i], timing) for ind, values, timing in records if values[i] is not None])
+
+
 def crunch_hessian_eigs(surf_file, net, w, s, d, dataloader, comm, rank, args):
     """
-        Calculate eigen values of the hessian matrix of a given model in parallel
-        using mpi reduce. This is the synchronized version.
+        Calculate eigen values of the hessian matrix of a given model in parallel.
+        The results are streamed to rank 0, which writes them to the surface file.
+
+        With --hess_batches, the Hessian of each eigensolve is that of a fixed random
+        subsample of batches, scaled to the number of batches of the full loader.
+        The solve is repeated on --hess_repeats independent subsamples, the mean is
+        stored as max_eig/min_eig and its standard error as max_eig_stderr/min_eig_stderr.
+
+        With --hess_quantities, the Hutchinson estimate of the trace is stored as
+        trace/trace_stderr, and the stochastic Lanczos quadrature of the eigenvalue
+        density as slq_nodes/slq_weights, with the nodes and weights of all probes of
+        a point in a vector, see hess_vec_prod.slq.
+
+        Each quantity is resumed on its own completion bitmaps, so that adding a
+        quantity to an existing file only calculates that quantity.
     """
     f = h5py.File(surf_file, 'r+' if rank == 0 else 'r')
-    min_eig, max_eig = [], []
     xcoordinates = f['xcoordinates'][:]
     ycoordinates = f['ycoordinates'][:] if 'ycoordinates' in f.keys() else None
 
-    if 'min_eig' not in f.keys():
-        shape = xcoordinates.shape if ycoordinates is None else (len(xcoordinates),len(ycoordinates))
-        max_eig = -np.ones(shape=shape)
-        min_eig = np.ones(shape=shape)
-        if rank == 0:
-            f['min_eig'] = min_eig
-            f['max_eig'] = max_eig
-    else:
-        min_eig = f['min_eig'][:]
-        max_eig = f['max_eig'][:]
-
-    # Generate a list of all indices that need to be filled in.
+    shape = xcoordinates.shape if ycoordinates is None else (len(xcoordinates),len(ycoordinates))
+    quantities = args.hess_quantities.split(',')
+    # the datasets of each quantity, and those whose bitmaps mark a point as calculated
+    groups = []
+    if 'eig' in quantities:
+        if 'min_eig' not in f.keys() and rank == 0:
+            h5_util.SurfaceWriter.create_dataset(f, 'min_eig', np.ones(shape=shape))
+            h5_util.SurfaceWriter.create_dataset(f, 'max_eig', -np.ones(shape=shape))
+        if 'eig_iters' not in f.keys() and rank == 0:
+            # the number of Hessian-vector products per point, e.g., to see the savings of --warm_start
+            h5_util.SurfaceWriter.create_dataset(f, 'eig_iters', np.zeros(shape=shape))
+        keys, done_keys = ['max_eig', 'min_eig', 'eig_iters'], ['max_eig', 'min_eig']
+        if args.hess_repeats > 1:
+            # the standard errors have their own bitmaps, so that the points of a
+            # file calculated without repeats are solved again
+            keys += ['max_eig_stderr', 'min_eig_stderr']
+            done_keys += ['max_eig_stderr', 'min_eig_stderr']
+            for key in keys[-2:]:
+                if key not in f.keys() and rank == 0:
+                    h5_util.SurfaceWriter.create_dataset(f, key, np.zeros(shape=shape))
+        groups.append(('eig', keys, done_keys))
+
+    # the trace and the SLQ nodes and weights (one vector per point) are marked
+    # in their completion bitmaps only, so they start out as NaN
+    new_keys = []
+    if 'trace' in quantities:
+        new_keys += [('trace', shape), ('trace_stderr', shape)]
+        groups.append(('trace', ['trace', 'trace_stderr'], ['trace']))
+    if 'density' in quantities:
+        size = args.slq_probes * args.slq_steps
+        new_keys += [('slq_nodes', shape + (size,)), ('slq_weights', shape + (size,))]
+        groups.append(('density', ['slq_nodes', 'slq_weights'], ['slq_nodes']))
+    for key, key_shape in new_keys:
+        if key not in f.keys() and rank == 0:
+            h5_util.SurfaceWriter.create_dataset(f, key, np.full(key_shape, np.nan), shape)
+
+    # Generate a list of all indices that need to be filled in, according to the
+    # completion bitmaps, since the eigenvalues may be negative. A point is
+    # calculated if any of its quantities is missing, and 'todo' holds the flat
+    # indices at which each quantity is missing.
     # The coordinates of each unfilled index are stored in 'coords'.
-    inds, coords, inds_nums = scheduler.get_job_indices(max_eig, xcoordinates, ycoordinates, comm)
+    todo = {}
+    for name, keys, done_keys in groups:
+        done = np.ones(shape, dtype=bool)
+        for key in done_keys:
+            done &= h5_util.read_done(f, key, shape)
+        todo[name] = ~done.ravel()
+    done = ~np.any(list(todo.values()), axis=0).reshape(shape)
+    inds, coords, inds_nums = scheduler.get_job_indices(done, xcoordinates, ycoordinates, comm, args.order)
     print('Computing %d values for rank %d'% (len(inds), rank))
 
+    # only rank 0 writes to the surface file, see mpi4pytorch.ResultStream
+    stream = mpi4pytorch.ResultStream(comm)
+    if rank == 0:
+        writers = [h5_util.SurfaceWriter(f, keys, args.flush_every, args.flush_secs, shape)
+                   for name, keys, done_keys in groups]
+
     criterion = nn.CrossEntropyLoss() # set the loss function criteria
 
+    # move the net to the device before its parameters are re-pointed into the flat buffer
+    if args.cuda:
+        net.cuda()
+    perturbation = net_plotter.get_perturbation(net.module if args.ngpu > 1 else net,
+                                                w, s, d, args.dir_type)
+
+    # The Ritz vectors of the last few points of this rank, by flat index. The
+    # eigenvectors of neighboring points are nearly the same, so the eigensolve of
+    # a point starts from the vectors of the nearest cached point. With --hess_repeats
+    # only the vectors of the last subsample of a point are kept, all repeats of the
+    # next point start from them.
+    nx = len(xcoordinates)
+    warm_cache = collections.OrderedDict()
+
     # Loop over all un-calculated coords
     start_time = time.time()
     total_sync = 0.0
+    total_iters = 0 # number of Hessian-vector products
 
     for count, ind in enumerate(inds):
          # Get the coordinates of the points being calculated
         coord = coords[count]
 
         # Load the weights corresponding to those coordinates into the net
-        if args.dir_type == 'weights':
-            net_plotter.set_weights(net.module if args.ngpu > 1 else net, w, d, coord)
-        elif args.dir_type == 'states':
-            net_plotter.set_states(net.module if args.ngpu > 1 else net, s, d, coord)
+        perturbation.step(coord)
 
-        # Compute the eign values of the hessian matrix
         compute_start = time.time()
-        maxeig, mineig, iter_count = hess_vec_prod.min_max_hessian_eigs(net, dataloader, \
-                                        criterion, rank=rank, use_cuda=args.cuda, verbose=True)
-        compute_time = time.time() - compute_start
-
-        # Record the result in the local array
-        max_eig.ravel()[ind] = maxeig
-        min_eig.ravel()[ind] = mineig
+        values, report = {}, ''
+
+        # Compute the eign values of the hessian matrix, on the full data or on
+        # each subsample, with the same batches for all products of one solve
+        if 'eig' in todo and todo['eig'][ind]:
+            v0 = None
+            if warm_cache:
+                near = min(warm_cache, key=lambda i: max(abs(i % nx - ind % nx), abs(i // nx - ind // nx)))
+                v0 = hess_vec_prod.warm_start_vector(warm_cache[near], args.warm_mix, seed=ind)
+            # a warm start already points to both ends of the spectrum, so the
+            # convergence test can be trusted after fewer products
+            min_iter = args.warm_min_iter if v0 is not None else 20
+
+            maxeigs, mineigs, iter_count = [], [], 0
+            for repeat in range(args.hess_repeats):
+                loader = dataloader if args.hess_batches <= 0 else subsample(dataloader, ind, repeat, args)
+                scale = len(dataloader) / float(len(loader))
+                results = hess_vec_prod.min_max_hessian_eigs(net, loader, \
+                                            criterion, rank=rank, use_cuda=args.cuda, verbose=True,
+                                            hvp_mode=args.hvp_mode, k=args.eig_k, tol=args.eig_tol,
+                                            max_iter=args.eig_max_iter, v0=v0,
+                                            return_vectors=args.warm_start > 0, min_iter=min_iter,
+                                            ncv=args.eig_ncv)
+                maxeigs.append(results[0] * scale)
+                mineigs.append(results[1] * scale)
+                iter_count += results[2]
+            maxeig, mineig = np.mean(maxeigs), np.mean(mineigs)
+            total_iters += iter_count
+
+            if args.warm_start > 0:
+                warm_cache[ind] = results[3]
+                if len(warm_cache) > args.warm_start:
+                    warm_cache.popitem(last=False)
+
+            values['eig'] = (maxeig, mineig, iter_count)
+            if args.hess_repeats > 1:
+                values['eig'] += (np.std(maxeigs, ddof=1) / np.sqrt(args.hess_repeats),
+                                  np.std(mineigs, ddof=1) / np.sqrt(args.hess_repeats))
+            report += ' \tmaxeig:%8.5f \tmineig:%8.5f \titer: %d' % (maxeig, mineig, iter_count)
+
+        # The trace and the spectral density, with batches of probes sharing a pass over the data
+        compute_trace = 'trace' in todo and todo['trace'][ind]
+        compute_density = 'density' in todo and todo['density'][ind]
+        if compute_trace or compute_density:
+            loader = dataloader if args.hess_batches <= 0 else subsample(dataloader, ind, 0, args)
+            scale = len(dataloader) / float(len(loader))
+            hvp = hess_vec_prod.HessVecProd(net, criterion, loader, args.cuda, mode=args.hvp_mode)
+            if compute_trace:
+                trace, trace_stderr = hess_vec_prod.hutchinson_trace(hvp, args.trace_probes,
+                                                                     args.probe_batch, args.probe_seed)
+                values['trace'] = (trace * scale, trace_stderr * scale)
+                report += ' \ttrace:%8.3f' % (trace * scale)
+            if compute_density:
+                nodes, weights = hess_vec_prod.slq(hvp, args.slq_probes, args.slq_steps,
+                                                   args.probe_batch, args.probe_seed)
+                values['density'] = (nodes.ravel() * scale, weights.ravel())
+            total_iters += hvp.count
 
+        compute_time = time.time() - compute_start
 
-        # Send updated plot data to the master node
+        # Send the result as a compact record to the master node, which stores it
+        # together with the records received from the other ranks so far.
+        # Only the master node writes to the file - this avoids write conflicts
         sync_start_time = time.time()
-        max_eig = mpi4pytorch.reduce_max(comm, max_eig)
-        min_eig = mpi4pytorch.reduce_min(comm, min_eig)
+        record = (ind, tuple(values.get(name) for name, keys, done_keys in groups), compute_time)
+        if rank == 0:
+            write_records(writers, [record] + stream.receive())
+        else:
+            stream.send(record)
         sync_time = time.time() - sync_start_time
         total_sync += sync_time
 
-        # Only the master node writes to the file - this avoids write conflicts
-        if rank == 0:
-            f['max_eig'][:] = max_eig
-            f['min_eig'][:] = min_eig
-
-        print("rank: %d %d/%d  (%0.2f%%)  %d\t  %s \tmaxeig:%8.5f \tmineig:%8.5f \titer: %d \ttime:%.2f \tsync:%.2f" % ( \
+        print("rank: %d %d/%d  (%0.2f%%)  %d\t  %s%s \ttime:%.2f \tsync:%.2f" % ( \
             rank, count + 1, len(inds), 100.0 * (count + 1)/len(inds), ind, str(coord), \
-            maxeig, mineig, iter_count, compute_time, sync_time))
+            report, compute_time, sync_time))
 
-    # This is only needed to make MPI run smoothly. If this process has less work
-    # than the rank0 process, then we need to keep calling allreduce so the rank0 process doesn't block
-    for i in range(max(inds_nums) - len(inds)):
-        max_eig = mpi4pytorch.reduce_max(comm, max_eig)
-        min_eig = mpi4pytorch.reduce_min(comm, min_eig)
+    # Wait for the remaining records of the other ranks
+    records = stream.close()
+    if rank == 0:
+        write_records(writers, records)
+        for writer in writers:
+            writer.close()
 
     total_time = time.time() - start_time
-    print('Rank %d done! Total time: %f Sync: %f '%(rank, total_time, total_sync))
+    print('Rank %d done! Total time: %f Sync: %f Products: %d'%(rank, total_time, total_sync, total_iters))
     f.close()
 
 
@@ -116,6 +256,25 @@ if __name__ == '__main__':
     parser.add_argument('--threads', default=2, type=int, help='number of threads')
     parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use for each rank, useful for data parallel evaluation')
     parser.add_argument('--batch_size', default=128, type=int, help='minibatch size')
+    parser.add_argument('--hvp_mode', default='fwdrev', help='Hessian-vector products: fwdrev (jvp of grad) | revrev (vjp of grad)')
+    parser.add_argument('--eig_k', default=1, type=int, help='number of eigenvalues the Lanczos iteration resolves at each end of the spectrum')
+    parser.add_argument('--eig_tol', default=1e-2, type=float, help='relative tolerance of the eigenvalues')
+    parser.add_argument('--eig_max_iter', default=100, type=int, help='maximum number of Hessian-vector products per point, the memory is bounded by --eig_ncv instead')
+    parser.add_argument('--eig_ncv', default=20, type=int, help='number of Lanczos vectors kept on the device, each of the size of the model, before the iteration is restarted')
+    parser.add_argument('--hess_batches', default=0, type=int, help='compute the Hessian of each eigensolve on a fixed random subsample of this many batches, 0 for the full data')
+    parser.add_argument('--hess_repeats', default=1, type=int, help='repeat the eigensolve on this many independent subsamples and store the standard error of the eigenvalues')
+    parser.add_argument('--hess_seed', default=0, type=int, help='seed of the subsamples')
+    parser.add_argument('--hess_shared', action='store_true', default=False, help='use the same subsamples at every grid point')
+    parser.add_argument('--hess_quantities', default='eig', help='comma separated quantities per point: eig (min/max eigenvalues) | trace (Hutchinson) | density (stochastic Lanczos quadrature)')
+    parser.add_argument('--trace_probes', default=16, type=int, help='number of Hutchinson probes of the trace')
+    parser.add_argument('--slq_probes', default=4, type=int, help='number of probes of the eigenvalue density')
+    parser.add_argument('--slq_steps', default=30, type=int, help='number of Lanczos steps per density probe')
+    parser.add_argument('--probe_batch', default=4, type=int, help='number of probes that share a pass over the data')
+    parser.add_argument('--probe_seed', default=0, type=int, help='seed of the probes, the same probes are used at every point')
+    parser.add_argument('--order', default='raster', help='evaluation order: raster | progressive (coarse-to-fine, for early previews) | snake (neighboring points in a row, for --warm_start)')
+    parser.add_argument('--warm_start', default=0, type=int, help='start each eigensolve from the eigenvectors of the nearest of the last N points of the rank, 0 for cold starts')
+    parser.add_argument('--warm_mix', default=0.1, type=float, help='relative size of the random component of the warm starting vector')
+    parser.add_argument('--warm_min_iter', default=8, type=int, help='minimum number of Hessian-vector products of a warm-started eigensolve, 20 for cold starts')
 
     # data parameters
     parser.add_argument('--dataset', default='cifar10', help='cifar10 | imagenet')
@@ -125,6 +284,7 @@ if __name__ == '__main__':
     parser.add_argument('--split_idx', default=0, type=int, help='the index of data splits for the dataloader')
     parser.add_argument('--trainloader', default='', help='path to the dataloader with random labels')
     parser.add_argument('--testloader', default='', help='path to the testloader with random labels')
+    parser.add_argument('--cache_dir', default='', help='local folder to cache the pre-normalized data as .npy files, from which --hess_batches subsamples are read directly')
 
     # model parameters
     parser.add_argument('--model', default='resnet56', help='model name')
@@ -145,12 +305,20 @@ if __name__ == '__main__':
     parser.add_argument('--yignore', default='', help='ignore bias and BN parameters: biasbn')
     parser.add_argument('--idx', default=0, type=int, help='the index for the repeatness experiment')
     parser.add_argument('--surf_file', default='', help='customize the name of surface file, could be an existing file.')
+    parser.add_argument('--flush_every', default=1, type=int, help='write the surface file after this many points')
+    parser.add_argument('--flush_secs', default=0, type=float, help='write the surface file after this many seconds')
+    parser.add_argument('--dir_cache', default='', help='local folder to cache the directions as memory-mapped .npy files')
 
     # plot parameters
     parser.add_argument('--show', action='store_true', default=False, help='show plotted figures')
     parser.add_argument('--plot', action='store_true', default=False, help='plot figures after computation')
 
     args = parser.parse_args()
+    assert all(q in ['eig', 'trace', 'density'] for q in args.hess_quantities.split(',')), \
+        'unknown Hessian quantity'
+    assert args.hess_repeats == 1 or args.hess_batches > 0, \
+        'repeated eigensolves on the full data give the same eigenvalues, set --hess_batches'
+    dataloader.check_cache_dir(args.cache_dir, args.trainloader, args.testloader)
 
     torch.manual_seed(123)
     #--------------------------------------------------------------------------
@@ -209,7 +377,7 @@ if __name__ == '__main__':
     mpi4pytorch.barrier(comm)
 
     # load directions
-    d = net_plotter.load_directions(dir_file)
+    d = net_plotter.load_directions(dir_file, args.dir_cache)
     # calculate the consine similarity of the two directions
     if len(d) == 2 and rank == 0:
         similarity = proj.cal_angle(proj.nplist_to_tensor(d[0]), proj.nplist_to_tensor(d[1]))
@@ -222,9 +390,19 @@ if __name__ == '__main__':
     if rank == 0 and args.dataset == 'cifar10':
         torchvision.datasets.CIFAR10(root=args.dataset + '/data', train=True, download=True)
 
+    # decode and normalize the data once into the cache folder
+    if rank == 0 and args.cache_dir:
+        dataloader.load_cached_dataset(args.dataset, args.datapath, args.batch_size,
+                                args.raw_data, args.data_split, args.split_idx, args.cache_dir)
+
     mpi4pytorch.barrier(comm)
 
-    trainloader, testloader = dataloader.load_dataset(args.dataset, args.datapath,
+    if args.cache_dir:
+        trainloader, testloader = dataloader.load_cached_dataset(args.dataset, args.datapath,
+                                args.batch_size, args.raw_data, args.data_split,
+                                args.split_idx, args.cache_dir)
+    else:
+        trainloader, testloader = dataloader.load_dataset(args.dataset, args.datapath,
                                 args.batch_size, args.threads, args.raw_data,
                                 args.data_split, args.split_idx,
                                 args.trainloader, args.testloader)
@@ -238,8 +416,10 @@ if __name__ == '__main__':
     #--------------------------------------------------------------------------
     # Plot figures
     #--------------------------------------------------------------------------
-    if args.plot and rank == 0:
+    if args.plot and rank == 0 and 'eig' in args.hess_quantities.split(','):
         if args.y:
             plot_2D.plot_2d_eig_ratio(surf_file, 'min_eig', 'max_eig', args.show)
         else:
             plot_1D.plot_1d_eig_ratio(surf_file, args.xmin, args.xmax, 'min_eig', 'max_eig')
+    if args.plot and rank == 0 and 'density' in args.hess_quantities.split(','):
+        plot_1D.plot_1d_eig_density(surf_file, args.xmin, args.xmax, show=args.show)
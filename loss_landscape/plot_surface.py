@@ -5,6 +5,7 @@
 """
 import argparse
 import copy
+import itertools
 import h5py
 import torch
 import time
@@ -13,6 +14,7 @@ import os
 import sys
 import numpy as np
 import torchvision
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import torch.nn as nn
 import dataloader
 import evaluation
@@ -22,6 +24,11 @@ import plot_2D
 import plot_1D
 import model_loader
 import scheduler
+import h5_util
+import prefix_cache
+import adaptive
+import fast_inference
+import tracing
 import mpi4pytorch as mpi
 
 def name_surface_file(args, dir_file):
@@ -70,88 +77,512 @@ def setup_surface_file(args, surf_file, dir_file):
     return surf_file
 
 
-def crunch(surf_file, net, w, s, d, dataloader, loss_key, acc_key, comm, rank, args):
+def get_criterion(args):
+    if args.loss_name == 'mse':
+        return nn.MSELoss()
+    return nn.CrossEntropyLoss()
+
+
+def early_stopping(args):
+    return args.loss_tol > 0 or args.max_samples > 0
+
+
+def fast_backend(args):
+    return args.fast or args.channels_last or args.bf16 or args.fold_bn or args.compile
+
+
+def get_fast_net(net, args, compile=True):
+    """ Wrap the net into the fast inference backend if any of its options is set. """
+    if not fast_backend(args):
+        return net
+    return fast_inference.FastNet(net, args.channels_last, args.bf16, args.fold_bn,
+                                  args.compile and compile)
+
+
+def check_fast_backend(net, w, s, d, loader, prefix_start, steps, criterion, args):
+    """
+        Compare the fast inference backend with the float32 reference at a few
+        coordinates on a copy of the net, and print the largest differences.
+        The compiled forward computes the same graph, so it is not compiled here.
+    """
+    net = copy.deepcopy(net)
+    if args.cuda:
+        net.cuda()
+    perturbation = net_plotter.get_perturbation(net, w, s, d, args.dir_type)
+    if prefix_start > 0:
+        net = prefix_cache.SuffixNet(net, prefix_start)
+    fast_net = get_fast_net(net, args, compile=False)
+    diffs = fast_inference.check_accuracy(net, fast_net, perturbation, criterion, loader,
+                                          steps, args.metrics, args.cuda)
+    print('Fast backend (%d BN layers folded) vs float32 at %d points, max abs diff: %s' % (
+          fast_net.num_folded, len(steps),
+          '  '.join('%s=%.2e' % (m, diff) for m, diff in zip(args.metrics, diffs))))
+
+
+def eval_block(net, perturbation, criterion, loaders, block, args, origin_losses=None):
+    """
+        Evaluate args.metrics on every loader for a block of (index, coordinate) jobs.
+        When stopping early, origin_losses are the per-sample losses of the
+        unperturbed model used as a control variate.
+
+        Returns:
+            a list of records (flat_index, values, loss_compute_time), with the values
+            of all metrics loader by loader, or (loss, acc, loss_stderr, nsamples)
+            when stopping early
+    """
+    block_coords = np.array([coord for ind, coord in block])
+
+    # Record the time to compute the loss values
+    loss_start = time.time()
+    with tracing.span('block', inds=[int(ind) for ind, coord in block]):
+        if early_stopping(args):
+            # Each point is evaluated on as many samples as its confidence interval needs
+            values = []
+            for coord in block_coords:
+                with tracing.span('weight_update'):
+                    perturbation.step(coord)
+                values.append(evaluation.eval_loss_early_stop(net, criterion, loaders[0],
+                                            args.loss_tol, args.max_samples, args.cuda,
+                                            origin_losses=origin_losses))
+        elif len(block) == 1:
+            # Load the weights corresponding to those coordinates into the net
+            with tracing.span('weight_update'):
+                perturbation.step(block_coords[0])
+            values = [evaluation.eval_metrics(net, criterion, loaders, args.metrics, args.cuda)]
+        else:
+            values = evaluation.eval_metrics_points(net.module if args.ngpu > 1 else net,
+                                            criterion, loaders, perturbation,
+                                            block_coords, args.metrics, args.cuda)
+    loss_compute_time = (time.time() - loss_start) / len(block)
+
+    return [(ind, tuple(value), loss_compute_time) for (ind, coord), value in zip(block, values)]
+
+
+###############################################################
+#                    Local worker processes
+###############################################################
+# the evaluation state of a local worker process, set up once by init_worker
+worker_state = {}
+
+def init_worker(net, w, s, d, loaders, prefix_start, origin_losses, args):
+    """
+        Set up a local worker process.
+
+        The tensors of the model, the weights/states and the directions arrive in
+        shared memory and the cached dataset is memory mapped, so nothing is copied
+        per task. Each worker flattens them into its own perturbation engine.
+        If prefix_start > 0, the loaders serve the cached prefix activations
+        and only the suffix of the model is evaluated.
+        origin_losses are the per-sample losses for the control variate, or None.
+    """
+    torch.set_num_threads(args.worker_threads)
+    torch.set_num_interop_threads(1)
+    if args.trace:
+        tracing.setup()
+    d = [h5_util.DirectionStore(flat.numpy(), shapes) for flat, shapes in d]
+    worker_state['perturbation'] = net_plotter.get_perturbation(net, w, s, d, args.dir_type)
+    if prefix_start > 0:
+        net = prefix_cache.SuffixNet(net, prefix_start)
+    worker_state['net'] = get_fast_net(net, args)
+    worker_state['criterion'] = get_criterion(args)
+    worker_state['loaders'] = loaders
+    worker_state['origin_losses'] = origin_losses
+    worker_state['args'] = args
+
+
+def eval_worker_block(block):
+    """
+        Evaluate a block of jobs in a local worker process, see eval_block.
+
+        Returns:
+            the records, the process id, the compile time of the worker so far and
+            the spans traced for the block
+    """
+    records = eval_block(worker_state['net'], worker_state['perturbation'], worker_state['criterion'],
+                         worker_state['loaders'], block, worker_state['args'],
+                         worker_state['origin_losses'])
+    return records, os.getpid(), getattr(worker_state['net'], 'compile_time', 0.0), tracing.drain()
+
+
+def start_workers(net, w, s, d, loaders, prefix_start, origin_losses, args):
+    """
+        Start a pool of args.workers local processes, each set up by init_worker.
+    """
+    # torch moves the tensors passed to the workers into shared memory, so the
+    # directions are handed over as tensors rather than pickled numpy buffers
+    d = [(torch.from_numpy(np.ascontiguousarray(direction.flat)), direction.shapes) for direction in d]
+    ctx = torch.multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(args.workers, mp_context=ctx, initializer=init_worker,
+                               initargs=(net, w, s, d, loaders, prefix_start, origin_losses, args))
+
+
+def crunch_local(pool, blocks, compile_times):
+    """
+        Evaluate blocks of jobs on a pool of local processes and yield the records of
+        each block as it completes. The compile time of each worker is kept in the
+        dict compile_times, and the spans traced by the workers are added to the
+        trace of the parent.
+    """
+    futures = [pool.submit(eval_worker_block, block) for block in blocks]
+    for future in as_completed(futures):
+        records, pid, compile_time, events = future.result()
+        compile_times[pid] = compile_time
+        tracing.add(events)
+        yield records
+
+
+def linear_logits(net, w, s, d, loaders, linear_name, args):
+    """
+        The logits of the final linear layer named linear_name in closed form, see
+        evaluation.eval_linear_logits: its input features are computed in a single
+        pass over the data and the logits are affine in the coordinates.
+    """
+    stages = prefix_cache.get_stages(net)
+
+    if args.dir_type == 'weights':
+        names = [name for name, p in net.named_parameters()]
+        base = w
+    else:
+        names = list(s.keys())
+        base = [s[name] for name in names]
+
+    def linear_tensors(tensors):
+        weight = torch.as_tensor(np.asarray(tensors[names.index(linear_name + '.weight')]))
+        if linear_name + '.bias' not in names:
+            return weight, torch.zeros(weight.shape[0])
+        return weight, torch.as_tensor(np.asarray(tensors[names.index(linear_name + '.bias')]))
+
+    weight, bias = linear_tensors([t.cpu() for t in base])
+    directions = [linear_tensors(direction) for direction in d]
+    return [evaluation.eval_linear_logits(weight, bias, directions,
+                prefix_cache.cache_prefix(net, len(stages) - 1, loader, use_cuda=args.cuda), args.cuda)
+            for loader in loaders]
+
+
+def crunch_linear(logits, criterion, blocks, args):
+    """
+        Evaluate blocks of jobs in closed form from the logits of linear_logits.
+        Yields the records of each block.
+    """
+    for block in blocks:
+        loss_start = time.time()
+        values = evaluation.eval_metrics_logits(criterion, logits, [coord for ind, coord in block], args.metrics)
+        loss_compute_time = (time.time() - loss_start) / len(block)
+        yield [(ind, tuple(value), loss_compute_time) for (ind, coord), value in zip(block, values)]
+
+
+class Evaluator(object):
+    """
+        The evaluation state of crunch that does not depend on the points to be
+        calculated: the loaders (of the cached prefix activations), the perturbation
+        engine and the (fast) net, the per-sample losses of the control variate, the
+        closed-form logits or the pool of local workers. It is built once, so that
+        every level of crunch_adaptive reuses it.
+    """
+
+    def __init__(self, surf_file, net, w, s, d, evals, comm, rank, args):
+        """
+            Args:
+                surf_file: the surface file, whose coordinates are used for the check
+                           of the fast backend and whose name for the prefix cache
+                evals: a list of (loader, keys) pairs, see crunch
+        """
+        self.loaders = [loader for loader, loader_keys in evals]
+        self.criterion = get_criterion(args)
+        self.args = args
+        self.net = net
+        self.pool = None
+
+        # With --linear_closed_form and only the final linear layer perturbed, the
+        # whole grid is evaluated in closed form on all samples
+        self.linear_name = None
+        if args.linear_closed_form:
+            self.linear_name = prefix_cache.final_linear(net, d, args.dir_type)
+            assert self.linear_name is not None, '--linear_closed_form needs directions that only perturb the final linear layer'
+            print('Rank %d evaluates the perturbed %s in closed form' % (rank, self.linear_name))
+            self.logits = linear_logits(net, w, s, d, self.loaders, self.linear_name, args)
+            return
+
+        # If the directions are zero for the first stages of the model, their output is
+        # computed once and every point only runs the perturbed suffix of the model
+        prefix_start = 0
+        if args.prefix_cache:
+            prefix_start = prefix_cache.first_perturbed_stage(net, d, args.dir_type)
+            print('Rank %d evaluates the model from stage %d' % (rank, prefix_start))
+        if prefix_start > 0:
+            # the cached activations also depend on the dataset options, see prefix_cache.prefix_fingerprint
+            data_key = '%s:%s:%s:%d:%d' % (args.dataset, os.path.abspath(args.datapath), args.raw_data,
+                                           args.data_split, args.split_idx)
+            for i, (loader, loader_keys) in enumerate(evals):
+                cache_file = ''
+                if args.cache_dir:
+                    cache_file = os.path.join(args.cache_dir, '%s_%s_prefix=%d' % (
+                                              os.path.basename(surf_file), loader_keys[0], prefix_start))
+                    # rank 0 writes the cached activations, the other ranks map them
+                    if rank == 0:
+                        self.loaders[i] = prefix_cache.cache_prefix(net, prefix_start, loader, cache_file, args.cuda,
+                                                                   data_key)
+                    mpi.barrier(comm)
+                if rank != 0 or not cache_file:
+                    self.loaders[i] = prefix_cache.cache_prefix(net, prefix_start, loader, cache_file, args.cuda,
+                                                                data_key)
+
+        # Check the accuracy of the fast inference backend at a few points of the grid
+        if fast_backend(args) and rank == 0 and args.fast_check > 0:
+            f = h5py.File(surf_file, 'r')
+            xcoordinates = f['xcoordinates'][:]
+            ycoordinates = f['ycoordinates'][:] if 'ycoordinates' in f.keys() else None
+            f.close()
+            size = len(xcoordinates) * (1 if ycoordinates is None else len(ycoordinates))
+            check_inds = np.unique(np.linspace(0, size - 1, args.fast_check).round().astype(int))
+            check_coords = [[xcoordinates[ind]] if ycoordinates is None else
+                            [xcoordinates[ind % len(xcoordinates)], ycoordinates[ind // len(xcoordinates)]]
+                            for ind in check_inds]
+            check_fast_backend(net, w, s, d, self.loaders[0], prefix_start, check_coords, self.criterion, args)
+
+        if args.workers > 1:
+            # Evaluate the blocks on a local process pool, the parent only writes the results.
+            # The net of the parent is not perturbed, so it provides the control variate.
+            origin_losses = None
+            if args.control_variate and early_stopping(args):
+                origin_net = prefix_cache.SuffixNet(net, prefix_start) if prefix_start > 0 else net
+                origin_losses = evaluation.eval_sample_losses(get_fast_net(origin_net, args, compile=False),
+                                                              self.criterion, self.loaders[0])
+            self.pool = start_workers(net, w, s, d, self.loaders, prefix_start, origin_losses, args)
+            return
+
+        # Flatten the weights/states and directions once, so that every point is a
+        # single in-place update. The net is moved to the device first since the
+        # parameters are re-pointed into the flat buffer on that device.
+        if args.cuda:
+            net.cuda()
+        self.perturbation = net_plotter.get_perturbation(net.module if args.ngpu > 1 else net,
+                                                         w, s, d, args.dir_type)
+        if prefix_start > 0:
+            net = prefix_cache.SuffixNet(net, prefix_start)
+        self.net = get_fast_net(net, args)
+
+        # The per-sample losses of the unperturbed model for the control variate
+        self.origin_losses = None
+        if args.control_variate and early_stopping(args):
+            self.perturbation.step(np.zeros(len(d)))
+            self.origin_losses = evaluation.eval_sample_losses(self.net, self.criterion, self.loaders[0], args.cuda)
+
+    def records(self, blocks, compile_times):
+        """ Yield the records of every block of jobs, see eval_block. """
+        if self.linear_name is not None:
+            return crunch_linear(self.logits, self.criterion, blocks, self.args)
+        if self.pool is not None:
+            return crunch_local(self.pool, blocks, compile_times)
+        return (eval_block(self.net, self.perturbation, self.criterion, self.loaders, block,
+                           self.args, self.origin_losses)
+                for block in blocks)
+
+    def close(self):
+        """ Shut down the local worker processes. """
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def crunch(surf_file, net, w, s, d, evals, comm, rank, args, evaluator=None):
     """
-        Calculate the loss values and accuracies of modified models in parallel
-        using MPI reduce.
+        Calculate the metrics of modified models in parallel, on several datasets in
+        a single schedule: the model is moved to each coordinate once and evaluated
+        on every loader.
+        The results are streamed to rank 0 as compact records, which are written
+        to the surface file by rank 0 only.
+
+        Args:
+            evals: a list of (loader, keys) pairs, with the names of the datasets in
+                   the surface file for args.metrics, e.g.,
+                   [(trainloader, ['train_loss', 'train_acc'])]
+            evaluator: the Evaluator of evals to reuse, or None to build one
     """
+    own_evaluator = evaluator is None
+    if own_evaluator:
+        evaluator = Evaluator(surf_file, net, w, s, d, evals, comm, rank, args)
 
     f = h5py.File(surf_file, 'r+' if rank == 0 else 'r')
-    losses, accuracies = [], []
     xcoordinates = f['xcoordinates'][:]
     ycoordinates = f['ycoordinates'][:] if 'ycoordinates' in f.keys() else None
-
-    if loss_key not in f.keys():
-        shape = xcoordinates.shape if ycoordinates is None else (len(xcoordinates),len(ycoordinates))
-        losses = -np.ones(shape=shape)
-        accuracies = -np.ones(shape=shape)
+    shape = xcoordinates.shape if ycoordinates is None else (len(xcoordinates),len(ycoordinates))
+    loss_key, acc_key = evals[0][1][:2]
+
+    # With early stopping, the standard error of the loss and the number of samples
+    # used for each point are stored alongside the loss values
+    keys = [key for loader, loader_keys in evals for key in loader_keys]
+    if early_stopping(args) and evaluator.linear_name is None:
+        keys += [loss_key + '_stderr', loss_key + '_nsamples']
+
+    for key in keys:
+        if key not in f.keys() and rank == 0:
+            h5_util.SurfaceWriter.create_dataset(f, key, -np.ones(shape=shape))
+
+    # A point is calculated unless the metrics of all loaders have been written, as
+    # recorded in the completion bitmaps of the datasets, so values <= 0 are not
+    # recomputed. The auxiliary early stopping values are written with them. All
+    # metrics of a point are evaluated together, so adding a metric or a loader to
+    # an existing file evaluates and rewrites every metric at every point.
+    done = np.ones(shape, dtype=bool)
+    for loader, loader_keys in evals:
+        for key in loader_keys:
+            done &= h5_util.read_done(f, key, shape)
+
+    # Generate a list of the indices that need to be filled in.
+    # The coordinates of each unfilled index (with respect to the direction vectors
+    # stored in 'd') are stored in 'coords'.
+    if args.scheduler == 'dynamic':
+        # Small chunks of the unfilled indices are handed out on demand by rank 0,
+        # together with their coordinates, so the other ranks need no job list
         if rank == 0:
-            f[loss_key] = losses
-            f[acc_key] = accuracies
+            inds, coords = scheduler.get_unplotted_indices(done, xcoordinates, ycoordinates, args.order)
+            num_jobs = len(inds)
+            print('Computing %d values over all ranks'% num_jobs)
+        else:
+            inds, coords, num_jobs = None, None, None
+        # a dedicated dispatcher on rank 0 stores the received records while it waits
+        idle = (lambda: writer.write(stream.receive())) if rank == 0 else None
+        jobs = iter(scheduler.WorkQueue(inds, coords, comm, args.chunk_size, idle))
     else:
-        losses = f[loss_key][:]
-        accuracies = f[acc_key][:]
+        inds, coords, inds_nums = scheduler.get_job_indices(done, xcoordinates, ycoordinates, comm, args.order)
+        jobs = iter(zip(inds, coords))
+        num_jobs = len(inds)
+        print('Computing %d values for rank %d'% (num_jobs, rank))
 
-    # Generate a list of indices of 'losses' that need to be filled in.
-    # The coordinates of each unfilled index (with respect to the direction vectors
-    # stored in 'd') are stored in 'coords'.
-    inds, coords, inds_nums = scheduler.get_job_indices(losses, xcoordinates, ycoordinates, comm)
+    # only rank 0 writes to the surface file, see mpi4pytorch.ResultStream
+    stream = mpi.ResultStream(comm)
+    if rank == 0:
+        writer = h5_util.SurfaceWriter(f, keys, args.flush_every, args.flush_secs)
 
-    print('Computing %d values for rank %d'% (len(inds), rank))
     start_time = time.time()
     total_sync = 0.0
+    block_size = 1 if early_stopping(args) else max(1, args.points_per_batch)
 
-    criterion = nn.CrossEntropyLoss()
-    if args.loss_name == 'mse':
-        criterion = nn.MSELoss()
-
-    # Loop over all uncalculated loss values
-    for count, ind in enumerate(inds):
-        # Get the coordinates of the loss value being calculated
-        coord = coords[count]
-
-        # Load the weights corresponding to those coordinates into the net
-        if args.dir_type == 'weights':
-            net_plotter.set_weights(net.module if args.ngpu > 1 else net, w, d, coord)
-        elif args.dir_type == 'states':
-            net_plotter.set_states(net.module if args.ngpu > 1 else net, s, d, coord)
+    if evaluator.linear_name is not None:
+        block_size = max(block_size, 1024)
 
-        # Record the time to compute the loss value
-        loss_start = time.time()
-        loss, acc = evaluation.eval_loss(net, criterion, dataloader, args.cuda)
-        loss_compute_time = time.time() - loss_start
-
-        # Record the result in the local array
-        losses.ravel()[ind] = loss
-        accuracies.ravel()[ind] = acc
+    # Blocks of up to args.points_per_batch coordinates are evaluated against each data batch
+    blocks = iter(lambda: list(itertools.islice(jobs, block_size)), [])
+    compile_times = {}
+    records_iter = evaluator.records(blocks, compile_times)
 
-        # Send updated plot data to the master node
+    # Loop over all uncalculated loss values
+    count = 0
+    for records in records_iter:
+        # Only the master node writes to the file - this avoids write conflicts
         syc_start = time.time()
-        losses     = mpi.reduce_max(comm, losses)
-        accuracies = mpi.reduce_max(comm, accuracies)
+        if rank == 0:
+            with tracing.span('mpi_sync'):
+                records_received = stream.receive()
+            writer.write(records + records_received)
+        else:
+            with tracing.span('mpi_sync'):
+                for record in records:
+                    stream.send(record)
         syc_time = time.time() - syc_start
         total_sync += syc_time
 
-        # Only the master node writes to the file - this avoids write conflicts
-        if rank == 0:
-            f[loss_key][:] = losses
-            f[acc_key][:] = accuracies
-            f.flush()
-
-        print('Evaluating rank %d  %d/%d  (%.1f%%)  coord=%s \t%s= %.3f \t%s=%.2f \ttime=%.2f \tsync=%.2f' % (
-                rank, count, len(inds), 100.0 * count/len(inds), str(coord), loss_key, loss,
-                acc_key, acc, loss_compute_time, syc_time))
-
-    # This is only needed to make MPI run smoothly. If this process has less work than
-    # the rank0 process, then we need to keep calling reduce so the rank0 process doesn't block
-    for i in range(max(inds_nums) - len(inds)):
-        losses = mpi.reduce_max(comm, losses)
-        accuracies = mpi.reduce_max(comm, accuracies)
+        for ind, values, loss_compute_time in records:
+            loss, acc = values[:2]
+            # the same coordinates as in scheduler.get_unplotted_indices
+            coord = np.array([xcoordinates[ind]] if ycoordinates is None else
+                             [xcoordinates[ind % len(xcoordinates)], ycoordinates[ind // len(xcoordinates)]])
+            # the other ranks of the dynamic scheduler do not know the number of jobs
+            progress = '%d' % count if num_jobs is None else '%d/%d  (%.1f%%)' % (count, num_jobs, 100.0 * count/num_jobs)
+            print('Evaluating rank %d  %s  coord=%s \t%s= %.3f \t%s=%.2f \ttime=%.2f \tsync=%.2f' % (
+                    rank, progress, str(coord), loss_key, loss,
+                    acc_key, acc, loss_compute_time, syc_time))
+            count += 1
+
+    # Wait for the remaining records of the other ranks
+    syc_start = time.time()
+    with tracing.span('mpi_sync'):
+        records = stream.close()
+    if rank == 0:
+        writer.write(records)
+        writer.close()
+        print('Compute time of all ranks: %.2f' % writer.compute_time)
+    total_sync += time.time() - syc_start
 
     total_time = time.time() - start_time
-    print('Rank %d done!  Total time: %.2f Sync: %.2f' % (rank, total_time, total_sync))
+    if args.compile:
+        # the first forward of each input shape, in every local process
+        compile_times[os.getpid()] = getattr(evaluator.net, 'compile_time', 0.0)
+        print('Rank %d done!  Total time: %.2f Sync: %.2f Compile: %.2f' % (
+              rank, total_time, total_sync, sum(compile_times.values())))
+    else:
+        print('Rank %d done!  Total time: %.2f Sync: %.2f' % (rank, total_time, total_sync))
 
     f.close()
+    if own_evaluator:
+        evaluator.close()
+
+def crunch_adaptive(surf_file, net, w, s, d, evals, comm, rank, args):
+    """
+        Calculate a 2D surface by adaptive quadtree refinement.
+
+        The values are first calculated on a sub-grid with stride args.adaptive_stride
+        and the cells whose variation or curvature exceeds args.adaptive_tol are split
+        until they reach the resolution of the dense grid. The samples are stored as
+        '<key>_samples' (NaN where not sampled) and the interpolated dense grid as
+        '<key>', so that the surface is plotted as usual. The completion bitmap of
+        '<key>' only marks the sampled points. The refinement follows the loss values
+        of the first loader.
+    """
+    sample_evals = [(loader, [key + '_samples' for key in keys]) for loader, keys in evals]
+    sample_keys = [key for loader, keys in sample_evals for key in keys]
+    # the perturbation, prefix cache and control variate are set up once for all levels
+    evaluator = Evaluator(surf_file, net, w, s, d, sample_evals, comm, rank, args)
+    cells = None
+    level = 0
+    while True:
+        # rank 0 clears the completion bits of the points to be calculated at this
+        # level, which are then calculated by crunch just like the points of a dense grid
+        num_points = 0
+        if rank == 0:
+            f = h5py.File(surf_file, 'r+')
+            shape = (len(f['xcoordinates']), len(f['ycoordinates']))
+            for key in sample_keys:
+                if key not in f.keys():
+                    h5_util.SurfaceWriter.create_dataset(f, key, np.full(shape, np.nan))
+                    h5_util.write_done(f, key, np.ones(shape, dtype=bool))
+            losses = f[sample_keys[0]][:]
+            if cells is None:
+                cells, mask = adaptive.initial_cells(losses.shape, args.adaptive_stride)
+                mask &= np.isnan(losses)
+            else:
+                cells, mask = adaptive.refine(losses, cells, args.adaptive_tol)
+            for key in sample_keys:
+                h5_util.write_done(f, key, h5_util.read_done(f, key, shape) & ~mask)
+            f.close()
+            num_points = mask.sum()
+            print('Level %d: %d cells, %d new points' % (level, len(cells), num_points))
+
+        # a level without new points has nothing to do, the points left over from
+        # an interrupted run are calculated at the first level
+        num_points = mpi.allreduce_max(comm, np.array([num_points]))[0]
+        if level > 0 and num_points == 0:
+            break
+        mpi.barrier(comm)
+        crunch(surf_file, net, w, s, d, sample_evals, comm, rank, args, evaluator)
+        mpi.barrier(comm)
+        level += 1
+    evaluator.close()
+
+    # interpolate the samples onto the dense grid, only the sampled points are marked
+    # as calculated, so that a later crunch of the dense grid evaluates the others
+    if rank == 0:
+        f = h5py.File(surf_file, 'r+')
+        for key, sample_key in zip([key for loader, keys in evals for key in keys], sample_keys):
+            samples = f[sample_key][:]
+            if key in f.keys():
+                del f[key]
+            h5_util.SurfaceWriter.create_dataset(f, key, adaptive.interpolate(samples))
+            h5_util.write_done(f, key, ~np.isnan(samples))
+        print('Sampled %d of %d points' % ((~np.isnan(samples)).sum(), samples.size))
+        f.close()
+    mpi.barrier(comm)
 
 ###############################################################
 #                          MAIN
@@ -163,6 +594,29 @@ if __name__ == '__main__':
     parser.add_argument('--threads', default=2, type=int, help='number of threads')
     parser.add_argument('--ngpu', type=int, default=1, help='number of GPUs to use for each rank, useful for data parallel evaluation')
     parser.add_argument('--batch_size', default=128, type=int, help='minibatch size')
+    parser.add_argument('--points_per_batch', default=1, type=int, help='number of grid points evaluated together on each data batch')
+    parser.add_argument('--scheduler', default='static', help='job scheduler: static | dynamic')
+    parser.add_argument('--order', default='raster', help='evaluation order: raster | progressive (coarse-to-fine, for early previews with plot_2D.py --preview)')
+    parser.add_argument('--chunk_size', default=1, type=int, help='number of grid points handed out per request of the dynamic scheduler')
+    parser.add_argument('--workers', default=1, type=int, help='number of local worker processes, an alternative to --mpi on a single node')
+    parser.add_argument('--metrics', default='loss,acc', help='metrics to calculate, loss and acc are always included: loss,acc,top5,margin,margin_std')
+    parser.add_argument('--test', action='store_true', default=False, help='also calculate the metrics on the test set, in the same pass')
+    parser.add_argument('--loss_tol', default=0, type=float, help='stop evaluating a point when the 95%% confidence interval of its loss is within +-loss_tol')
+    parser.add_argument('--max_samples', default=0, type=int, help='evaluate each point on at most this many samples, 0 for all')
+    parser.add_argument('--control_variate', action='store_true', default=False, help='use the per-sample losses of the unperturbed model as a control variate when stopping early')
+    parser.add_argument('--adaptive', action='store_true', default=False, help='refine 2D surfaces adaptively instead of calculating every point')
+    parser.add_argument('--adaptive_stride', default=8, type=int, help='stride of the initial sub-grid of the adaptive refinement')
+    parser.add_argument('--adaptive_tol', default=0.1, type=float, help='refine the cells whose loss variation or curvature exceeds this value')
+    parser.add_argument('--prefix_cache', action='store_true', default=False, help='cache the activations of the unperturbed first layers and evaluate only the perturbed suffix')
+    parser.add_argument('--linear_closed_form', action='store_true', default=False, help='evaluate the whole grid in closed form when the directions only perturb the final linear layer')
+    parser.add_argument('--fast', action='store_true', default=False, help='evaluate with the fast inference backend (torch.inference_mode), implied by the options below')
+    parser.add_argument('--channels_last', action='store_true', default=False, help='fast backend: evaluate on channels_last tensors')
+    parser.add_argument('--bf16', action='store_true', default=False, help='fast backend: evaluate with bfloat16 autocast')
+    parser.add_argument('--fold_bn', action='store_true', default=False, help='fast backend: fold the BatchNorm layers into the preceding conv/linear layers at every point')
+    parser.add_argument('--compile', action='store_true', default=False, help='fast backend: compile the forward with torch.compile once, with the parameters as inputs')
+    parser.add_argument('--fast_check', default=3, type=int, help='number of grid points at which the fast backend is compared with float32')
+    parser.add_argument('--trace', default='', help='record the spans of every point and save them as <trace>.json (Chrome trace) and <trace>.jsonl (summary)')
+    parser.add_argument('--worker_threads', default=0, type=int, help='number of torch threads per local worker, 0 divides the cores evenly')
 
     # data parameters
     parser.add_argument('--dataset', default='cifar10', help='cifar10 | imagenet')
@@ -172,6 +626,7 @@ if __name__ == '__main__':
     parser.add_argument('--split_idx', default=0, type=int, help='the index of data splits for the dataloader')
     parser.add_argument('--trainloader', default='', help='path to the dataloader with random labels')
     parser.add_argument('--testloader', default='', help='path to the testloader with random labels')
+    parser.add_argument('--cache_dir', default='', help='local folder to cache the pre-normalized evaluation data as .npy files')
 
     # model parameters
     parser.add_argument('--model', default='resnet56', help='model name')
@@ -193,6 +648,9 @@ if __name__ == '__main__':
     parser.add_argument('--same_dir', action='store_true', default=False, help='use the same random direction for both x-axis and y-axis')
     parser.add_argument('--idx', default=0, type=int, help='the index for the repeatness experiment')
     parser.add_argument('--surf_file', default='', help='customize the name of surface file, could be an existing file.')
+    parser.add_argument('--flush_every', default=1, type=int, help='write the surface file after this many points')
+    parser.add_argument('--flush_secs', default=0, type=float, help='write the surface file after this many seconds')
+    parser.add_argument('--dir_cache', default='', help='local folder to cache the directions as memory-mapped .npy files')
 
     # plot parameters
     parser.add_argument('--proj_file', default='', help='the .h5 file contains projected optimization trajectory.')
@@ -216,6 +674,29 @@ if __name__ == '__main__':
     else:
         comm, rank, nproc = None, 0, 1
 
+    args.metrics = ['loss', 'acc'] + [m for m in args.metrics.split(',') if m and m not in ['loss', 'acc']]
+    assert all(m in evaluation.METRICS for m in args.metrics), 'unknown metric in --metrics'
+    if early_stopping(args):
+        assert args.metrics == ['loss', 'acc'] and not args.test, 'stopping early only estimates the training loss'
+    dataloader.check_cache_dir(args.cache_dir, args.trainloader, args.testloader)
+    if args.control_variate:
+        assert args.cache_dir, '--control_variate needs the fixed sample order of --cache_dir'
+    if args.prefix_cache:
+        assert args.ngpu == 1, '--prefix_cache evaluates the model on a single device'
+    if args.linear_closed_form:
+        assert args.ngpu == 1, '--linear_closed_form evaluates the final linear layer on a single device'
+    if fast_backend(args):
+        assert args.ngpu == 1, 'the fast inference backend evaluates the model on a single device'
+    if args.compile:
+        assert args.points_per_batch == 1, '--compile evaluates one point at a time'
+
+    # local worker processes share the model, directions and cached dataset of the parent
+    if args.workers > 1:
+        assert not args.mpi and not args.cuda, '--workers runs on the CPUs of a single node without --mpi'
+        assert args.cache_dir, '--workers needs the memory-mapped dataset of --cache_dir'
+        if args.worker_threads <= 0:
+            args.worker_threads = max(1, (os.cpu_count() or 1) // args.workers)
+
     # in case of multiple GPUs per node, set the GPU to use for each rank
     if args.cuda:
         if not torch.cuda.is_available():
@@ -263,7 +744,7 @@ if __name__ == '__main__':
     mpi.barrier(comm)
 
     # load directions
-    d = net_plotter.load_directions(dir_file)
+    d = net_plotter.load_directions(dir_file, args.dir_cache)
     # calculate the consine similarity of the two directions
     if len(d) == 2 and rank == 0:
         similarity = proj.cal_angle(proj.nplist_to_tensor(d[0]), proj.nplist_to_tensor(d[1]))
@@ -276,18 +757,44 @@ if __name__ == '__main__':
     if rank == 0 and args.dataset == 'cifar10':
         torchvision.datasets.CIFAR10(root=args.dataset + '/data', train=True, download=True)
 
+    # decode and normalize the data once into the cache folder
+    if rank == 0 and args.cache_dir:
+        dataloader.load_cached_dataset(args.dataset, args.datapath, args.batch_size,
+                                args.raw_data, args.data_split, args.split_idx, args.cache_dir)
+
     mpi.barrier(comm)
 
-    trainloader, testloader = dataloader.load_dataset(args.dataset, args.datapath,
+    # stopping early needs the training data in a random order
+    shuffle = early_stopping(args)
+    if args.cache_dir:
+        trainloader, testloader = dataloader.load_cached_dataset(args.dataset, args.datapath,
+                                args.batch_size, args.raw_data, args.data_split,
+                                args.split_idx, args.cache_dir, shuffle)
+    else:
+        trainloader, testloader = dataloader.load_dataset(args.dataset, args.datapath,
                                 args.batch_size, args.threads, args.raw_data,
                                 args.data_split, args.split_idx,
-                                args.trainloader, args.testloader)
+                                args.trainloader, args.testloader, shuffle)
 
     #--------------------------------------------------------------------------
     # Start the computation
     #--------------------------------------------------------------------------
-    crunch(surf_file, net, w, s, d, trainloader, 'train_loss', 'train_acc', comm, rank, args)
-    # crunch(surf_file, net, w, s, d, testloader, 'test_loss', 'test_acc', comm, rank, args)
+    # evaluate the metrics on the training set, and on the test set in the same pass
+    evals = [(trainloader, ['train_' + metric for metric in args.metrics])]
+    if args.test:
+        evals.append((testloader, ['test_' + metric for metric in args.metrics]))
+
+    if args.trace:
+        tracing.setup(rank)
+
+    if args.adaptive:
+        assert args.y, '--adaptive refines 2D surfaces'
+        crunch_adaptive(surf_file, net, w, s, d, evals, comm, rank, args)
+    else:
+        crunch(surf_file, net, w, s, d, evals, comm, rank, args)
+
+    if args.trace:
+        tracing.export(args.trace, comm)
 
     #--------------------------------------------------------------------------
     # Plot figures
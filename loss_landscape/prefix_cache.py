@@ -0,0 +1,224 @@
+"""
+    Evaluate only the perturbed suffix of a model on cached activations.
+
+    When the directions are zero for all early layers, the output of those layers
+    is the same at every grid point. The model is split into a sequence of stages,
+    the unperturbed activations at the input of the first perturbed stage are
+    computed once per dataset, and each grid point runs only the remaining stages.
+"""
+
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import dataloader
+import h5_util
+import cifar10.models.vgg as vgg
+import cifar10.models.resnet as resnet
+import cifar10.models.densenet as densenet
+
+
+def get_stages(net):
+    """ Split the forward pass of a cifar10 model into a sequence of stages.
+
+        Args:
+            net: the neural net model
+
+        Returns:
+            a list of (module_names, function) pairs, where module_names are the
+            names of the modules in 'net' whose parameters/states are used by the
+            stage, or None if the architecture is not supported. The last stage is
+            always the final nn.Linear of the model.
+    """
+    stages = []
+    if isinstance(net, (resnet.ResNet, resnet.ResNet_cifar, resnet.WResNet_cifar)):
+        pool_size = 4 if isinstance(net, resnet.ResNet) else 8
+        stages.append((['conv1', 'bn1'], lambda x: F.relu(net.bn1(net.conv1(x)))))
+        for layer in ['layer1', 'layer2', 'layer3', 'layer4']:
+            if hasattr(net, layer):
+                for i, block in enumerate(getattr(net, layer)):
+                    stages.append((['%s.%d' % (layer, i)], block))
+        stages.append(([], lambda x: F.avg_pool2d(x, pool_size).view(x.size(0), -1)))
+        stages.append((['linear'], net.linear))
+
+    elif isinstance(net, vgg.VGG):
+        # one stage per conv-bn-relu unit or pooling layer, so that the in-place
+        # ReLU never modifies the cached activations
+        start = 0
+        for i in range(1, len(net.features) + 1):
+            if i == len(net.features) or not isinstance(net.features[i], (nn.BatchNorm2d, nn.ReLU)):
+                stages.append((['features.%d' % j for j in range(start, i)], net.features[start:i]))
+                start = i
+        stages.append((['fc'], lambda x: net.fc(x.view(x.size(0), -1))))
+        stages.append((['classifier'], net.classifier))
+
+    elif isinstance(net, densenet.DenseNet):
+        stages.append((['conv1'], net.conv1))
+        for i in range(1, 5):
+            for j, block in enumerate(getattr(net, 'dense%d' % i)):
+                stages.append((['dense%d.%d' % (i, j)], block))
+            if i < 4:
+                stages.append((['trans%d' % i], getattr(net, 'trans%d' % i)))
+        stages.append((['bn'], lambda x: F.avg_pool2d(F.relu(net.bn(x)), 4).view(x.size(0), -1)))
+        stages.append((['linear'], net.linear))
+
+    else:
+        return None
+
+    return stages
+
+
+def first_perturbed_stage(net, directions, dir_type='weights'):
+    """ Find the index of the first stage of 'net' with a nonzero direction.
+
+        Args:
+            net: the neural net model
+            directions: a list of directions, each with one entry per parameter
+                        (dir_type='weights') or per state (dir_type='states')
+            dir_type: 'weights' or 'states'
+
+        Returns:
+            the stage index, 0 if the model has to be evaluated completely
+    """
+    stages = get_stages(net)
+    if stages is None:
+        return 0
+
+    if dir_type == 'weights':
+        names = [name for name, p in net.named_parameters()]
+    else:
+        names = list(net.state_dict().keys())
+    perturbed = [name for i, name in enumerate(names)
+                 if any(np.any(np.asarray(d[i]) != 0) for d in directions)]
+
+    def in_stage(name, module_names):
+        return any(name.startswith(m + '.') for m in module_names)
+
+    # be conservative for perturbed tensors that do not belong to any stage
+    if any(not any(in_stage(name, s[0]) for s in stages) for name in perturbed):
+        return 0
+
+    for k, (module_names, fn) in enumerate(stages):
+        if any(in_stage(name, module_names) for name in perturbed):
+            return k
+    return len(stages) - 1
+
+
+def final_linear(net, directions, dir_type='weights'):
+    """ Return the name of the final nn.Linear of 'net' if the directions perturb
+        nothing else, None otherwise.
+    """
+    stages = get_stages(net)
+    if stages is None or first_perturbed_stage(net, directions, dir_type) < len(stages) - 1:
+        return None
+    return stages[-1][0][0]
+
+
+class SuffixNet(nn.Module):
+    """
+        The stages of 'net' from 'start' on, applied to the activations cached by
+        cache_prefix. The children of 'net' are registered under the same names,
+        so the parameter names and the perturbation of 'net' apply unchanged.
+    """
+
+    def __init__(self, net, start):
+        super(SuffixNet, self).__init__()
+        for name, module in net.named_children():
+            self.add_module(name, module)
+        self.stages = get_stages(net)[start:]
+
+    def forward(self, x):
+        for module_names, fn in self.stages:
+            x = fn(x)
+        return x
+
+
+def prefix_fingerprint(net, start, loader, data_key=''):
+    """ A hash of everything the activations at the input of stage 'start' depend on:
+        the stage, the parameters and states of the modules of the first stages, the
+        order of the loader and, for a TensorBatchLoader, the path, size and mtime of
+        its files, as well as data_key, e.g., the options of the dataset.
+    """
+    h = hashlib.sha1(('%d:%s:%s:%s' % (start, data_key, getattr(loader, 'shuffle', False),
+                                        getattr(loader, 'seed', 0))).encode())
+    if isinstance(loader, dataloader.TensorBatchLoader):
+        for fname in [loader.data_file, loader.label_file]:
+            stat = os.stat(fname)
+            h.update(('%s:%d:%d' % (os.path.abspath(fname), stat.st_size, stat.st_mtime_ns)).encode())
+    module_names = [m for names, fn in get_stages(net)[:start] for m in names]
+    for name, t in net.state_dict().items():
+        if any(name.startswith(m + '.') for m in module_names):
+            h.update(name.encode())
+            h.update(t.detach().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+def num_samples(loader):
+    if isinstance(loader, dataloader.TensorBatchLoader):
+        return len(loader.data)
+    return len(loader.sampler)
+
+
+def cache_prefix(net, start, loader, cache_file='', use_cuda=False, data_key=''):
+    """ Compute the unperturbed activations at the input of stage 'start' once.
+
+        Args:
+            net: the neural net model, holding the unperturbed weights
+            start: index of the first stage that is not cached
+            loader: dataloader
+            cache_file: if given, the activations are saved as '<cache_file>_<hash>_data.npy'
+                        and '<cache_file>_<hash>_labels.npy' and served memory mapped,
+                        otherwise they are kept in memory. The files are reused only
+                        for the same prefix_fingerprint.
+            use_cuda: use cuda or not
+            data_key: the identity of the data that the loader does not show, see
+                      prefix_fingerprint
+
+        Returns:
+            a loader of (activations, targets) batches. A cached TensorBatchLoader
+            keeps the random order of a shuffled TensorBatchLoader, e.g., for
+            early stopping on the first samples.
+    """
+    # the order of the samples, so that early stopping sees a random subset
+    shuffle, seed = getattr(loader, 'shuffle', False), getattr(loader, 'seed', 0)
+    if cache_file:
+        cache_file += '_' + prefix_fingerprint(net, start, loader, data_key)
+        data_file, label_file = cache_file + '_data.npy', cache_file + '_labels.npy'
+        if os.path.exists(data_file) and os.path.exists(label_file):
+            return dataloader.TensorBatchLoader(data_file, label_file, loader.batch_size, shuffle, seed)
+
+    stages = get_stages(net)[:start]
+    if use_cuda:
+        net.cuda()
+    net.eval()
+
+    def prefix_batches():
+        with torch.no_grad():
+            for inputs, targets in loader:
+                if use_cuda:
+                    inputs = inputs.cuda()
+                for module_names, fn in stages:
+                    inputs = fn(inputs)
+                yield inputs.cpu(), targets
+
+    if not cache_file:
+        return list(prefix_batches())
+
+    with h5_util.atomic_file(data_file) as data_tmp, h5_util.atomic_file(label_file) as label_tmp:
+        data, labels, loc = None, None, 0
+        for inputs, targets in prefix_batches():
+            if data is None:
+                n = num_samples(loader)
+                data = np.lib.format.open_memmap(data_tmp, mode='w+', dtype=np.float32,
+                                                 shape=(n,) + tuple(inputs.shape[1:]))
+                labels = np.lib.format.open_memmap(label_tmp, mode='w+', dtype=np.int64, shape=(n,))
+            data[loc:loc + len(inputs)] = inputs.numpy()
+            labels[loc:loc + len(inputs)] = targets.numpy()
+            loc += len(inputs)
+        assert data is not None, 'cannot cache the activations of an empty loader'
+        data.flush()
+        labels.flush()
+        del data, labels
+    return dataloader.TensorBatchLoader(data_file, label_file, loader.batch_size, shuffle, seed)
@@ -33,6 +33,11 @@ def nplist_to_tensor(nplist):
         Returns:
             concatnated 1D tensor
     """
+    if isinstance(nplist, h5_util.DirectionStore) and \
+            all(len(shape) > 0 for shape in nplist.shapes):
+        # the direction is already one contiguous vector
+        return nplist.tensor().double()
+
     v = []
     for d in nplist:
         w = torch.tensor(d*np.float64(1.0))
@@ -2,34 +2,71 @@
     A task scheduler that assign unfinished jobs to different workers.
 """
 import numpy as np
+import threading
+import time
 
-def get_unplotted_indices(vals, xcoordinates, ycoordinates=None):
+def progressive_order(inds, nx, ny=1):
+    """
+    Sort flat indices of a grid (x index ind % nx, y index ind // nx) in a
+    progressive multi-resolution order: first the points on every 2^k-th row and
+    column (and the last ones) for the largest k, then the points added by halving
+    the stride, down to stride 1. Within each level the points keep their order.
+    Only the given indices are looked at, so the cost does not depend on the grid size.
+    """
+    top = 1 << int(np.ceil(np.log2(max(nx, ny, 2))))
+    stride = np.full(len(inds), top)
+    for g, n in [(inds % nx, nx), (inds // nx, ny)]:
+        # the largest power of 2 dividing the index, the first and last index belong to the top level
+        lowbit = np.where((g == 0) | (g == n - 1), top, g & -g)
+        stride = np.minimum(stride, lowbit)
+    return inds[np.argsort(-stride, kind='stable')]
+
+
+def snake_order(inds, nx):
+    """
+    Sort flat indices of a grid (x index ind % nx, y index ind // nx) in a
+    boustrophedon order: row by row, with every other row traversed backwards, so
+    that consecutive points are neighbors on the grid. A contiguous slice of the
+    sorted indices, e.g., the jobs of one rank, is a spatially coherent path.
+    """
+    ix, iy = inds % nx, inds // nx
+    key = iy * nx + np.where(iy % 2 == 0, ix, nx - 1 - ix)
+    return inds[np.argsort(key, kind='stable')]
+
+
+def get_unplotted_indices(vals, xcoordinates, ycoordinates=None, order='raster'):
     """
     Args:
-      vals: values at (x, y), with value -1 when the value is not yet calculated.
+      vals: a boolean completion map, True where the point has been calculated
+            (see h5_util.read_done), or values at (x, y) where the values <= 0
+            are taken as not calculated yet.
       xcoordinates: x locations, i.e.,[-1, -0.5, 0, 0.5, 1]
       ycoordinates: y locations, i.e.,[-1, -0.5, 0, 0.5, 1]
+      order: 'raster', 'progressive' or 'snake', see progressive_order and snake_order
 
     Returns:
       - a list of indices into vals for points that have not yet been calculated.
       - a list of corresponding coordinates, with one x/y coordinate per row.
     """
 
-    # Create a list of indices into the vectorizes vals
-    inds = np.array(range(vals.size))
+    # Select the indices of the missing entries of the vectorized vals. With values
+    # instead of a completion map, the negative values (other than loss values) would
+    # be selected again and calculated over and over.
+    if vals.dtype == bool:
+        inds = np.flatnonzero(~vals.ravel())
+    else:
+        inds = np.flatnonzero(vals.ravel() <= 0)
 
-    # Select the indices of the un-recorded entries, assuming un-recorded entries
-    # will be smaller than zero. In case some vals (other than loss values) are
-    # negative and those indexces will be selected again and calcualted over and over.
-    inds = inds[vals.ravel() <= 0]
+    nx = len(xcoordinates)
+    if order == 'progressive':
+        inds = progressive_order(inds, nx, 1 if ycoordinates is None else len(ycoordinates))
+    elif order == 'snake':
+        inds = snake_order(inds, nx)
 
-    # Make lists containing the x- and y-coodinates of the points to be plotted
+    # The coordinates of the missing points only, the value at index ind is at
+    # x = xcoordinates[ind % nx], y = ycoordinates[ind // nx]
     if ycoordinates is not None:
-        # If the plot is 2D, then use meshgrid to enumerate all coordinates in the 2D mesh
-        xcoord_mesh, ycoord_mesh = np.meshgrid(xcoordinates, ycoordinates)
-        s1 = xcoord_mesh.ravel()[inds]
-        s2 = ycoord_mesh.ravel()[inds]
-        return inds, np.c_[s1,s2]
+        return inds, np.c_[xcoordinates[inds % nx], ycoordinates[inds // nx]]
     else:
         return inds, xcoordinates.ravel()[inds]
 
@@ -58,15 +95,19 @@ def split_inds(num_inds, nproc):
     return splitted_idx
 
 
-def get_job_indices(vals, xcoordinates, ycoordinates, comm):
+def get_job_indices(vals, xcoordinates, ycoordinates, comm, order='raster'):
     """
     Prepare the job indices over which coordinate to calculate.
 
     Args:
-        vals: the value matrix
+        vals: the completion map or the value matrix, see get_unplotted_indices
         xcoordinates: x locations, i.e.,[-1, -0.5, 0, 0.5, 1]
         ycoordinates: y locations, i.e.,[-1, -0.5, 0, 0.5, 1]
         comm: MPI environment
+        order: 'raster', 'progressive' or 'snake', in the progressive order the jobs
+               are dealt out round-robin so that all ranks refine the grid together,
+               otherwise each rank gets a contiguous slice, i.e., in the snake order
+               a path of neighboring points
 
     Returns:
         inds: indices that splitted for current rank
@@ -74,11 +115,14 @@ def get_job_indices(vals, xcoordinates, ycoordinates, comm):
         inds_nums: max number of indices for all ranks
     """
 
-    inds, coords = get_unplotted_indices(vals, xcoordinates, ycoordinates)
+    inds, coords = get_unplotted_indices(vals, xcoordinates, ycoordinates, order)
 
     rank = 0 if comm is None else comm.Get_rank()
     nproc = 1 if comm is None else comm.Get_size()
-    splitted_idx = split_inds(len(inds), nproc)
+    if order == 'progressive':
+        splitted_idx = [range(r, len(inds), nproc) for r in range(nproc)]
+    else:
+        splitted_idx = split_inds(len(inds), nproc)
 
     # Split the indices over the available MPI processes
     inds = inds[splitted_idx[rank]]
@@ -88,3 +132,153 @@ def get_job_indices(vals, xcoordinates, ycoordinates, comm):
     inds_nums = [len(idx) for idx in splitted_idx]
 
     return inds, coords, inds_nums
+
+
+class WorkQueue(object):
+    """
+    A dynamic scheduler that hands out small chunks of unfilled indices on demand,
+    so that fast MPI processes keep working while slow ones finish their chunks.
+      - Rank 0 owns the queue. It answers the requests of the other ranks with a
+        coordinator thread if MPI supports multiple threads. Otherwise rank 0 is a
+        dedicated dispatcher without jobs of its own if there are more than two
+        ranks, so that no rank waits for a chunk while rank 0 evaluates a point,
+        and with two ranks it polls for requests between its own jobs.
+      - Iterating over the queue yields (index, coordinate) pairs of the jobs
+        assigned to the current rank until the queue is empty. The indices and
+        coordinates of a chunk are sent with it, so only rank 0 needs the job list.
+    """
+
+    REQUEST, REPLY = 11, 12
+
+    def __init__(self, inds, coords, comm=None, chunk_size=1, idle=None):
+        """
+        Args:
+            inds: indices of all jobs, e.g., from get_unplotted_indices,
+                  only used on rank 0
+            coords: coordinates of all jobs, only used on rank 0
+            comm: MPI environment
+            chunk_size: number of jobs handed out per request
+            idle: called by a dedicated dispatcher between the requests, e.g., to
+                  store the results received so far
+        """
+        self.inds = inds
+        self.coords = coords
+        self.chunk_size = max(1, chunk_size)
+        self.next = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        self.dispatcher = False
+        self.idle = idle
+
+        self.rank = 0 if comm is None else comm.Get_rank()
+        self.nproc = 1 if comm is None else comm.Get_size()
+        # a separate communicator, as in mpi4pytorch.ResultStream
+        self.comm = None if comm is None or self.nproc == 1 else comm.Dup()
+        self.finished = 0 # number of ranks that received an empty chunk
+
+        if self.comm is not None and self.rank == 0:
+            from mpi4py import MPI
+            if MPI.Query_thread() == MPI.THREAD_MULTIPLE:
+                self.thread = threading.Thread(target=self.serve, args=(True,))
+                self.thread.daemon = True
+                self.thread.start()
+            else:
+                self.dispatcher = self.nproc > 2
+
+    def take(self):
+        """ Take the indices and coordinates of the next chunk of jobs from the queue (rank 0 only). """
+        with self.lock:
+            start = self.next
+            self.next = min(start + self.chunk_size, len(self.inds))
+            return self.inds[start:self.next], self.coords[start:self.next]
+
+    def serve(self, block):
+        """ Answer the chunk requests of the other ranks (rank 0 only). """
+        from mpi4py import MPI
+        status = MPI.Status()
+        while self.finished < self.nproc - 1:
+            if not block and not self.comm.Iprobe(source=MPI.ANY_SOURCE, tag=self.REQUEST):
+                return
+            self.comm.recv(source=MPI.ANY_SOURCE, tag=self.REQUEST, status=status)
+            chunk = self.take()
+            self.comm.send(chunk, dest=status.Get_source(), tag=self.REPLY)
+            if len(chunk[0]) == 0:
+                self.finished += 1
+
+    def dispatch(self):
+        """ Answer the requests until every other rank has been told to stop (rank 0 only). """
+        while self.finished < self.nproc - 1:
+            self.serve(block=False)
+            if self.idle is not None:
+                self.idle()
+            time.sleep(0.001)
+
+    def get_chunk(self):
+        """ Get the indices and coordinates of the next chunk of jobs for the current rank. """
+        if self.rank == 0:
+            if self.comm is not None and self.thread is None:
+                self.serve(block=False)
+            return self.take()
+        self.comm.send(None, dest=0, tag=self.REQUEST)
+        return self.comm.recv(source=0, tag=self.REPLY)
+
+    def __iter__(self):
+        if self.dispatcher:
+            self.dispatch()
+        while not self.dispatcher:
+            inds, coords = self.get_chunk()
+            if len(inds) == 0:
+                break
+            for ind, coord in zip(inds, coords):
+                yield ind, coord
+
+        # rank 0 keeps serving until every other rank has been told to stop
+        if self.comm is not None and self.rank == 0:
+            if self.thread is not None:
+                self.thread.join()
+            else:
+                self.serve(block=True)
+        if self.comm is not None:
+            self.comm.Free()
+            self.comm = None
+
+
+###############################################################
+####                        MAIN
+###############################################################
+
+if __name__ == '__main__':
+    # Compare the wall-clock time of the static and dynamic schedulers on jobs
+    # whose cost differs between ranks, e.g.,
+    #   mpirun -n 4 python scheduler.py --jobs 64 --job_time 0.05
+    import argparse
+    import mpi4pytorch as mpi
+
+    parser = argparse.ArgumentParser(description='Benchmark the job schedulers')
+    parser.add_argument('--jobs', default=64, type=int, help='number of jobs')
+    parser.add_argument('--job_time', default=0.05, type=float, help='time per job on the fastest rank')
+    parser.add_argument('--chunk_size', default=1, type=int, help='jobs per request of the dynamic scheduler')
+    args = parser.parse_args()
+
+    comm = mpi.setup_MPI()
+    rank = 0 if comm is None else comm.Get_rank()
+    vals = -np.ones(args.jobs)
+    xcoordinates = np.linspace(-1, 1, args.jobs)
+    job_time = args.job_time * (1 + rank) # rank r is (r + 1) times slower than rank 0
+
+    for name in ['static', 'dynamic']:
+        mpi.barrier(comm)
+        start = time.time()
+        if name == 'static':
+            inds, coords, inds_nums = get_job_indices(vals, xcoordinates, None, comm)
+            jobs = zip(inds, coords)
+        else:
+            inds, coords = get_unplotted_indices(vals, xcoordinates) if rank == 0 else (None, None)
+            jobs = WorkQueue(inds, coords, comm, args.chunk_size)
+        count = 0
+        for ind, coord in jobs:
+            time.sleep(job_time)
+            count += 1
+        mpi.barrier(comm)
+        mpi.print_once(comm, '%s scheduler: %.2f s' % (name, time.time() - start))
+        print('  rank %d: %d jobs' % (rank, count))
@@ -0,0 +1,62 @@
+import numpy as np
+import adaptive
+
+
+def sample(f, mask, Z=None):
+    """ Sample f at the points of mask into Z (NaN elsewhere). """
+    if Z is None:
+        Z = np.full(mask.shape, np.nan)
+    Z[mask] = f[mask]
+    return Z
+
+
+def test_initial_cells():
+    cells, mask = adaptive.initial_cells((9, 10), 4)
+    # the last row and column are always included
+    assert cells == [(0, 4, 0, 4), (0, 4, 4, 8), (0, 4, 8, 9),
+                     (4, 8, 0, 4), (4, 8, 4, 8), (4, 8, 8, 9)]
+    assert set(map(tuple, np.argwhere(mask))) == {(i, j) for i in [0, 4, 8] for j in [0, 4, 8, 9]}
+
+
+def test_refine_flat():
+    cells, mask = adaptive.initial_cells((9, 9), 4)
+    Z = sample(np.ones((9, 9)), mask)
+    new_cells, new_mask = adaptive.refine(Z, cells, 0.1)
+    assert new_cells == [] and not new_mask.any()
+
+
+def test_refine_bump():
+    f = np.zeros((9, 9))
+    f[8, 8] = 1.0
+    cells, mask = adaptive.initial_cells((9, 9), 4)
+    Z = sample(f, mask)
+    new_cells, new_mask = adaptive.refine(Z, cells, 0.5)
+    # the cell with the bump in its corner is split, and the cells whose second
+    # differences reach the bump, but not the opposite cell
+    split = {(4, 8, 4, 8), (0, 4, 4, 8), (4, 8, 0, 4)}
+    assert sorted(new_cells) == sorted((i, i + 2, j, j + 2) for i0, i1, j0, j1 in split
+                                       for i in [i0, i0 + 2] for j in [j0, j0 + 2])
+    # the new points of the split cells, without the sampled corners
+    points = {(i, j) for i0, i1, j0, j1 in split for i in range(i0, i1 + 1, 2) for j in range(j0, j1 + 1, 2)}
+    assert set(map(tuple, np.argwhere(new_mask))) == points - set(map(tuple, np.argwhere(mask)))
+
+
+def test_refine_to_dense():
+    # a cell of one grid step is never split, so the refinement ends at the dense grid
+    x = np.linspace(-1, 1, 17)
+    f = np.exp(-20 * (x[:, None] ** 2 + x[None, :] ** 2))
+    cells, mask = adaptive.initial_cells(f.shape, 8)
+    Z = sample(f, mask)
+    while cells:
+        cells, mask = adaptive.refine(Z, cells, 0.05)
+        Z = sample(f, mask, Z)
+    assert np.isnan(Z).any()
+    assert np.abs(adaptive.interpolate(Z) - f).max() < 0.1
+
+
+def test_interpolate_linear():
+    x, y = np.meshgrid(np.arange(9), np.arange(7), indexing='ij')
+    f = 2.0 * x - y + 1
+    cells, mask = adaptive.initial_cells(f.shape, 4)
+    dense = adaptive.interpolate(sample(f, mask))
+    assert np.allclose(dense, f)
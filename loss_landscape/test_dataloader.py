@@ -0,0 +1,69 @@
+import pickle
+import numpy as np
+import torch
+from PIL import Image
+import dataloader
+
+
+class FakeCIFAR10(object):
+    """ A small CIFAR10-shaped dataset served like torchvision.datasets.CIFAR10. """
+
+    def __init__(self, root, train=True, download=False, transform=None):
+        rng = np.random.RandomState(0 if train else 1)
+        n = 24 if train else 10
+        self.data = rng.randint(0, 256, (n, 32, 32, 3)).astype(np.uint8)
+        self.targets = list(rng.randint(0, 10, n))
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        img = Image.fromarray(self.data[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index]
+
+
+def test_load_cached_dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataloader.torchvision.datasets, 'CIFAR10', FakeCIFAR10)
+    for raw_data in [False, True]:
+        for data_split, split_idx in [(1, 0), (3, 1)]:
+            train_loader, test_loader = dataloader.load_dataset('cifar10', str(tmp_path), 5, 0, raw_data,
+                                                                data_split, split_idx)
+            cached_train, cached_test = dataloader.load_cached_dataset('cifar10', str(tmp_path), 5, raw_data,
+                                                                       data_split, split_idx,
+                                                                       str(tmp_path / 'cache'))
+            # the same samples as the torchvision transforms, the split in the order of its indices
+            trainset = train_loader.dataset
+            inds = np.sort(dataloader.get_split_indices(len(trainset), data_split))
+            expected = torch.stack([trainset[i][0] for i in inds])
+            assert torch.allclose(torch.cat([x for x, y in cached_train]), expected, atol=1e-6)
+            assert torch.equal(torch.cat([y for x, y in cached_train]),
+                               torch.tensor([trainset[i][1] for i in inds]))
+
+            inputs, targets = zip(*test_loader)
+            assert torch.allclose(torch.cat([x for x, y in cached_test]), torch.cat(inputs), atol=1e-6)
+            assert torch.equal(torch.cat([y for x, y in cached_test]), torch.cat(targets))
+
+
+def test_tensor_batch_loader_shuffle(tmp_path):
+    data = np.arange(23 * 2, dtype=np.float32).reshape(23, 2)
+    np.save(tmp_path / 'data.npy', data)
+    np.save(tmp_path / 'labels.npy', np.arange(23))
+    files = str(tmp_path / 'data.npy'), str(tmp_path / 'labels.npy')
+
+    loader = dataloader.TensorBatchLoader(*files, batch_size=5, shuffle=True, seed=7)
+    batches = [y.tolist() for x, y in loader]
+    # every batch is a sorted slice of the permutation of the seed
+    order = np.random.RandomState(7).permutation(23)
+    assert batches == [sorted(order[i:i + 5]) for i in range(0, 23, 5)]
+    assert sorted(sum(batches, [])) == list(range(23))
+    assert batches != [y.tolist() for x, y in dataloader.TensorBatchLoader(*files, batch_size=5)]
+
+    # the same order in every pass, in every process and after pickling
+    assert [y.tolist() for x, y in loader] == batches
+    assert [y.tolist() for x, y in dataloader.TensorBatchLoader(*files, 5, True, 7)] == batches
+    assert [y.tolist() for x, y in pickle.loads(pickle.dumps(loader))] == batches
+    for x, y in loader:
+        assert torch.equal(x, torch.from_numpy(data[y.numpy()]))
@@ -0,0 +1,127 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import dataloader
+import evaluation
+import net_plotter
+
+
+def make_batches(num_batches=3, batch_size=7, features=6, classes=4):
+    torch.manual_seed(1)
+    return [(torch.randn(batch_size, features), torch.randint(0, classes, (batch_size,)))
+            for i in range(num_batches)]
+
+
+def test_eval_linear_logits():
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Linear(6, 5), nn.Tanh(), nn.Linear(5, 4)).eval()
+    batches = make_batches()
+    criterion = nn.CrossEntropyLoss()
+    weight, bias = net[2].weight.detach().clone(), net[2].bias.detach().clone()
+    directions = [(torch.randn(4, 5), torch.randn(4)) for i in range(2)]
+
+    # the closed form on the features at the input of the final linear layer
+    with torch.no_grad():
+        features = [(net[:2](x), y) for x, y in batches]
+    logits = evaluation.eval_linear_logits(weight, bias, directions, features)
+    steps = [[0.0, 0.0], [0.5, -0.25], [-1.0, 2.0]]
+    values = evaluation.eval_metrics_logits(criterion, [logits], steps, evaluation.METRICS)
+
+    for step, value in zip(steps, values):
+        with torch.no_grad():
+            net[2].weight.copy_(weight + step[0] * directions[0][0] + step[1] * directions[1][0])
+            net[2].bias.copy_(bias + step[0] * directions[0][1] + step[1] * directions[1][1])
+        expected = evaluation.eval_metrics(net, criterion, [batches], evaluation.METRICS)
+        assert np.allclose(value, expected, rtol=1e-5, atol=1e-5)
+
+
+def make_loader(tmp_path, n=30, batch_size=4):
+    rng = np.random.RandomState(0)
+    np.save(tmp_path / 'data.npy', rng.randn(n, 6).astype(np.float32))
+    np.save(tmp_path / 'labels.npy', rng.randint(0, 4, n))
+    return dataloader.TensorBatchLoader(str(tmp_path / 'data.npy'), str(tmp_path / 'labels.npy'),
+                                        batch_size, shuffle=True, seed=3)
+
+
+def test_eval_loss_early_stop(tmp_path):
+    torch.manual_seed(0)
+    net = nn.Linear(6, 4)
+    criterion = nn.CrossEntropyLoss()
+    loader = make_loader(tmp_path)
+    losses = evaluation.eval_sample_losses(net, criterion, loader).numpy()
+
+    # without a tolerance and budget, the mean of the whole dataset
+    loss, acc, stderr, total = evaluation.eval_loss_early_stop(net, criterion, loader, 0)
+    assert total == 30
+    assert np.isclose(loss, losses.mean())
+    assert np.isclose(stderr, losses.std(ddof=1) / np.sqrt(30))
+    assert np.isclose(acc, evaluation.eval_loss(net, criterion, loader)[1])
+
+    # the budget stops at the end of the batch that reaches it
+    loss, acc, stderr, total = evaluation.eval_loss_early_stop(net, criterion, loader, 0, max_samples=10)
+    assert total == 12
+    assert np.isclose(loss, losses[:12].mean())
+    assert np.isclose(stderr, losses[:12].std(ddof=1) / np.sqrt(12))
+
+    # the first batch whose confidence interval is narrow enough
+    tol = 1.96 * losses[:16].std(ddof=1) / np.sqrt(16)
+    loss, acc, stderr, total = evaluation.eval_loss_early_stop(net, criterion, loader, tol * 1.0001)
+    n = [m for m in range(4, 31, 4) if 1.96 * losses[:m].std(ddof=1) / np.sqrt(m) <= tol * 1.0001][0]
+    assert total == n and n <= 16
+    assert 1.96 * stderr <= tol * 1.0001
+
+
+def test_eval_loss_control_variate(tmp_path):
+    torch.manual_seed(0)
+    net = nn.Linear(6, 4)
+    criterion = nn.CrossEntropyLoss()
+    loader = make_loader(tmp_path)
+    origin_losses = evaluation.eval_sample_losses(net, criterion, loader)
+    L0 = origin_losses.numpy()
+
+    # at the origin the control variate cancels the sampling error
+    loss, acc, stderr, total = evaluation.eval_loss_early_stop(net, criterion, loader, 1e-6,
+                                                               origin_losses=origin_losses)
+    assert total == 4
+    assert np.isclose(loss, L0.mean()) and stderr == 0
+
+    # at a perturbed point, the controlled estimate of the first 12 samples
+    with torch.no_grad():
+        net.weight.add_(0.1 * torch.randn(4, 6))
+    L = evaluation.eval_sample_losses(net, criterion, loader).numpy()
+    loss, acc, stderr, total = evaluation.eval_loss_early_stop(net, criterion, loader, 0, max_samples=12,
+                                                               origin_losses=origin_losses)
+    L, L0_sub = L[:12], L0[:12]
+    cov = np.mean(L * L0_sub) - L.mean() * L0_sub.mean()
+    beta = cov / L0_sub.var()
+    assert total == 12
+    assert np.isclose(loss, L.mean() - beta * (L0_sub.mean() - L0.mean()))
+    assert np.isclose(stderr, np.sqrt((L.var() - beta * cov) / 11))
+    assert stderr < L.std(ddof=1) / np.sqrt(12)
+
+
+def test_eval_metrics_points(make_net):
+    net = make_net(lambda: nn.Sequential(nn.Linear(6, 5), nn.BatchNorm1d(5), nn.ReLU(), nn.Linear(5, 4)))
+    loaders = [make_batches(2), make_batches(1, batch_size=5)]
+    criterion = nn.CrossEntropyLoss()
+    steps = np.array([[0.0, 0.0], [0.3, -0.2], [-0.5, 1.0]])
+
+    for dir_type in ['weights', 'states']:
+        w = [p.detach().clone() for p in net.parameters()]
+        s = copy.deepcopy(net.state_dict())
+        base = w if dir_type == 'weights' else list(s.values())
+        d = [[0.2 * torch.randn(b.shape) for b in base] for i in range(2)]
+
+        batched_net = copy.deepcopy(net)
+        perturbation = net_plotter.get_perturbation(batched_net, w, s, d, dir_type)
+        values = evaluation.eval_metrics_points(batched_net, criterion, loaders, perturbation,
+                                                steps, evaluation.METRICS)
+        assert len(values) == len(steps) and values[0] != values[1]
+
+        point_net = copy.deepcopy(net)
+        perturbation = net_plotter.get_perturbation(point_net, w, s, d, dir_type)
+        for step, value in zip(steps, values):
+            perturbation.step(step)
+            expected = evaluation.eval_metrics(point_net, criterion, loaders, evaluation.METRICS)
+            assert np.allclose(value, expected, rtol=1e-5, atol=1e-5)
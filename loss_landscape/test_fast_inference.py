@@ -0,0 +1,87 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import fast_inference
+import net_plotter
+
+
+class Net(nn.Module):
+    def __init__(self):
+        super(Net, self).__init__()
+        self.conv1 = nn.Conv2d(3, 8, 3, padding=1, bias=False)
+        self.bn1 = nn.BatchNorm2d(8)
+        self.conv2 = nn.Conv2d(8, 8, 3, stride=2, padding=1, groups=2)
+        self.bn2 = nn.BatchNorm2d(8, affine=False)
+        self.fc = nn.Linear(8 * 4 * 4, 10)
+        self.bn3 = nn.BatchNorm1d(10)
+
+    def forward(self, x):
+        x = torch.relu(self.bn1(self.conv1(x)))
+        x = torch.relu(self.bn2(self.conv2(x)))
+        return self.bn3(self.fc(x.view(x.size(0), -1)))
+
+
+def test_fold_batchnorm(make_net):
+    net = make_net(Net)
+    x = torch.randn(4, 3, 8, 8)
+    with torch.no_grad():
+        expected = net(x)
+        gm, num_folded = fast_inference.trace(net, fold_bn=True)
+        assert num_folded == 3
+        assert not any(isinstance(m, (nn.BatchNorm1d, nn.BatchNorm2d))
+                       for node in gm.graph.nodes if node.op == 'call_module'
+                       for m in [gm.get_submodule(node.target)])
+        assert torch.allclose(gm(x), expected, atol=1e-5)
+
+        # the folded weights follow the parameters of the net, e.g., at another grid point
+        for p in net.parameters():
+            p.add_(0.1)
+        assert torch.allclose(gm(x), net(x), atol=1e-5)
+
+
+def test_fold_batchnorm_shared_output():
+    # a layer whose output is also used elsewhere is not folded
+    class Branch(nn.Module):
+        def __init__(self):
+            super(Branch, self).__init__()
+            self.fc = nn.Linear(4, 4)
+            self.bn = nn.BatchNorm1d(4)
+
+        def forward(self, x):
+            y = self.fc(x)
+            return self.bn(y) + y
+
+    net = Branch().eval()
+    net.bn.running_mean.normal_()
+    x = torch.randn(3, 4)
+    with torch.no_grad():
+        gm, num_folded = fast_inference.trace(net, fold_bn=True)
+        assert num_folded == 0
+        assert torch.allclose(gm(x), net(x))
+
+
+def test_check_accuracy_nan(make_net):
+    net = make_net(Net)
+    s = copy.deepcopy(net.state_dict())
+    # a negative running variance of bn1 at the step 1 gives NaN outputs
+    d = [[-5 * torch.ones_like(v) if k == 'bn1.running_var' else torch.zeros_like(v, dtype=torch.float32)
+          for k, v in s.items()]]
+    perturbation = net_plotter.get_perturbation(net, None, s, d, 'states')
+    loader = [(torch.randn(4, 3, 8, 8), torch.randint(0, 10, (4,)))]
+    metrics = ['loss', 'margin']
+
+    # the NaN values of both models are equal
+    fast_net = fast_inference.FastNet(net, fold_bn=True)
+    diffs = fast_inference.check_accuracy(net, fast_net, perturbation, nn.CrossEntropyLoss(), loader,
+                                          [[0.0], [1.0]], metrics)
+    assert np.all(diffs < 1e-4)
+
+    # a NaN of only one of them is a mismatch
+    class Zeros(nn.Module):
+        def forward(self, x):
+            return torch.zeros(x.size(0), 10)
+
+    diffs = fast_inference.check_accuracy(net, Zeros(), perturbation, nn.CrossEntropyLoss(), loader,
+                                          [[0.0], [1.0]], metrics)
+    assert np.all(np.isinf(diffs))
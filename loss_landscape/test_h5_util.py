@@ -0,0 +1,63 @@
+import h5py
+import numpy as np
+import pytest
+import h5_util
+
+
+def test_write_read_done(tmp_path):
+    shape = (5, 3)
+    done = np.random.RandomState(0).rand(*shape) > 0.5
+    with h5py.File(tmp_path / 'surf.h5', 'w') as f:
+        h5_util.write_done(f, 'train_loss', done)
+        assert np.array_equal(h5_util.read_done(f, 'train_loss', shape), done)
+        # a missing dataset has no points calculated
+        assert not h5_util.read_done(f, 'test_loss', shape).any()
+
+
+def test_set_bits(tmp_path):
+    shape = (7, 3)
+    with h5py.File(tmp_path / 'surf.h5', 'w') as f:
+        h5_util.SurfaceWriter.create_dataset(f, 'train_loss', -np.ones(shape))
+        assert not h5_util.read_done(f, 'train_loss', shape).any()
+        # repeated and unsorted indices, several of them in the same byte
+        inds = np.array([20, 0, 3, 9, 3, 8])
+        h5_util.set_bits(f[h5_util.done_key('train_loss')], inds)
+        done = np.zeros(shape, dtype=bool)
+        done.ravel()[inds] = True
+        assert np.array_equal(h5_util.read_done(f, 'train_loss', shape), done)
+
+
+def test_legacy_fallback(tmp_path):
+    shape = (4, 4)
+    losses = -np.ones(shape)
+    losses[1, 2] = 0.0
+    losses[3, 0] = 2.5
+    with h5py.File(tmp_path / 'surf.h5', 'w') as f:
+        # a file written before the bitmaps, with the -1 initial values
+        f['train_loss'] = losses
+        f['train_acc'] = np.zeros(shape)
+        assert np.array_equal(h5_util.read_done(f, 'train_loss', shape), losses != -1)
+
+        # the writer gives all datasets of a record the bitmap of the first one
+        writer = h5_util.SurfaceWriter(f, ['train_loss', 'train_acc'])
+        writer.write([(5, (1.5, 50.0), 0.1)])
+        writer.close()
+        done = losses != -1
+        done.ravel()[5] = True
+        for key in ['train_loss', 'train_acc']:
+            assert np.array_equal(h5_util.read_done(f, key, shape), done)
+        assert f['train_loss'][1, 1] == 1.5 and f['train_acc'][1, 1] == 50.0
+
+
+def test_atomic_save(tmp_path):
+    fname = str(tmp_path / 'data.npy')
+    h5_util.atomic_save(fname, np.arange(5))
+    assert np.array_equal(np.load(fname), np.arange(5))
+
+    # a failed block leaves neither a temporary file nor a partial file behind
+    with pytest.raises(RuntimeError):
+        with h5_util.atomic_file(str(tmp_path / 'failed.npy')) as tmp_file:
+            with open(tmp_file, 'wb') as fp:
+                np.save(fp, np.arange(3))
+            raise RuntimeError('interrupted')
+    assert [p.name for p in tmp_path.iterdir()] == ['data.npy']
@@ -0,0 +1,141 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.func import functional_call
+import hess_vec_prod
+
+
+def random_matrix(eigenvalues, seed=0):
+    rng = np.random.RandomState(seed)
+    U, _ = np.linalg.qr(rng.randn(len(eigenvalues), len(eigenvalues)))
+    return torch.tensor(U @ np.diag(eigenvalues) @ U.T, dtype=torch.float64)
+
+
+def exact_hessian(net, names, batches, criterion):
+    """ The Hessian of the loss summed over the batches w.r.t. the flat parameters 'names'. """
+    params = dict(net.named_parameters())
+    shapes = [params[name].shape for name in names]
+    numels = [params[name].numel() for name in names]
+
+    def loss(theta):
+        p = {name: v.detach() for name, v in params.items()}
+        for name, shape, t in zip(names, shapes, torch.split(theta, numels)):
+            p[name] = t.view(shape)
+        return sum(criterion(functional_call(net, p, (x,)), y) for x, y in batches)
+
+    theta = torch.cat([params[name].detach().reshape(-1) for name in names])
+    return torch.autograd.functional.hessian(loss, theta)
+
+
+def test_hess_vec_prod():
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Linear(3, 4), nn.Tanh(), nn.Linear(4, 3)).double()
+    batches = [(torch.randn(5, 3, dtype=torch.float64), torch.randint(0, 3, (5,))) for i in range(3)]
+    criterion = nn.CrossEntropyLoss()
+    for include_bn in [False, True]:
+        for mode in ['fwdrev', 'revrev']:
+            hvp = hess_vec_prod.HessVecProd(net, criterion, batches, include_bn=include_bn, mode=mode)
+            H = exact_hessian(net, hvp.names, batches, criterion)
+            assert hvp.size == len(H) == (24 if not include_bn else 31)
+            V = torch.randn(4, hvp.size, dtype=torch.float64)
+            assert torch.allclose(hvp(V[0]), H @ V[0], atol=1e-10)
+            assert torch.allclose(hvp.matmat(V), V @ H, atol=1e-10)
+            assert hvp.count == 5
+
+
+def test_eval_hess_vec_prod():
+    # the legacy helpers give the same products as HessVecProd
+    torch.manual_seed(0)
+    net = nn.Sequential(nn.Linear(3, 4), nn.Tanh(), nn.Linear(4, 3))
+    batches = [(torch.randn(5, 3), torch.randint(0, 3, (5,))) for i in range(3)]
+    criterion = nn.CrossEntropyLoss()
+    hvp = hess_vec_prod.HessVecProd(net, criterion, batches)
+    v = np.random.RandomState(0).randn(hvp.size)
+
+    params = [p for p in net.parameters() if len(p.size()) > 1]
+    hess_vec_prod.eval_hess_vec_prod(hess_vec_prod.npvec_to_tensorlist(v, params), params, net,
+                                     criterion, batches)
+    expected = hvp(torch.from_numpy(v)).numpy()
+    assert np.allclose(hess_vec_prod.gradtensor_to_npvec(net), expected, atol=1e-5)
+
+
+def check_ends(A, k, ncv, tol=1e-2):
+    ev = np.linalg.eigvalsh(A.numpy())
+    v0 = torch.randn(len(A), generator=torch.Generator().manual_seed(0), dtype=torch.float64)
+    top, bottom, count = hess_vec_prod.lanczos(lambda v: A @ v, v0, k=k, tol=tol, max_iter=500, ncv=ncv)
+    scale = np.abs(ev).max()
+    assert np.allclose(top, ev[::-1][:k], rtol=tol, atol=1e-2 * tol * scale)
+    assert np.allclose(bottom, ev[:k], rtol=tol, atol=1e-2 * tol * scale)
+    return count
+
+
+def test_lanczos_spd():
+    A = random_matrix(np.logspace(-2, 1, 60))
+    for k in [1, 2]:
+        check_ends(A, k, ncv=20)
+
+
+def test_lanczos_indefinite():
+    # the small negative end appears late in the Krylov sequence
+    A = random_matrix(np.r_[-0.5, np.linspace(0, 1, 150), [5, 20, 100]])
+    assert check_ends(A, 1, ncv=200) >= 20
+
+
+def test_lanczos_restart():
+    # a basis of 10 vectors is restarted several times
+    A = random_matrix(np.r_[-np.logspace(-3, 0, 20), np.logspace(-4, 2, 180)], seed=1)
+    assert check_ends(A, 1, ncv=10) > 10
+
+
+def test_lanczos_vectors():
+    A = random_matrix(np.r_[-2, np.linspace(-1, 1, 40), 3])
+    v0 = torch.ones(len(A), dtype=torch.float64)
+    top, bottom, count, vectors = hess_vec_prod.lanczos(lambda v: A @ v, v0, tol=1e-6, max_iter=500,
+                                                        return_vectors=True)
+    for theta, v in zip(np.r_[top, bottom], vectors):
+        assert abs(v.norm().item() - 1) < 1e-8
+        assert (A @ v - theta * v).norm().item() < 1e-3
+
+
+class MatrixProd(object):
+    """ The products with an explicit matrix, in place of a HessVecProd. """
+
+    def __init__(self, A):
+        self.A = A
+        self.size = len(A)
+        self.theta = torch.zeros(len(A), dtype=A.dtype)
+
+    def matmat(self, V):
+        return V @ self.A
+
+
+def test_hutchinson_trace():
+    A = random_matrix(np.r_[-1, np.linspace(0, 2, 49)])
+    trace, stderr = hess_vec_prod.hutchinson_trace(MatrixProd(A), num_probes=64, probe_batch=5)
+    assert stderr > 0
+    assert abs(trace - np.trace(A.numpy())) < 4 * stderr
+
+
+def test_slq():
+    A = random_matrix(np.r_[-1, np.linspace(0, 2, 49)])
+    ev = np.linalg.eigvalsh(A.numpy())
+    nodes, weights = hess_vec_prod.slq(MatrixProd(A), num_probes=5, steps=12, probe_batch=2)
+    assert nodes.shape == weights.shape == (5, 12)
+    assert np.allclose(weights.sum(1), 1)
+    assert np.all(nodes >= ev.min() - 1e-8) and np.all(nodes <= ev.max() + 1e-8)
+    # the isolated eigenvalue is a node of the quadrature
+    assert abs(nodes.min() - ev.min()) < 1e-6
+
+    # the smoothed density integrates to 1
+    grid = np.linspace(-2, 3, 1001)
+    density = hess_vec_prod.slq_density(nodes.ravel(), weights.ravel(), grid, 0.05)
+    assert abs(density.sum() * (grid[1] - grid[0]) - 1) < 1e-3
+
+
+def test_slq_invariant_subspace():
+    # a probe spans at most 3 eigenvectors, the remaining steps are padded with zero weights
+    A = random_matrix(np.r_[np.ones(10), 2 * np.ones(10), 3 * np.ones(10)])
+    nodes, weights = hess_vec_prod.slq(MatrixProd(A), num_probes=2, steps=8)
+    assert np.allclose(weights.sum(1), 1)
+    assert np.all(weights[:, 3:] == 0)
+    assert np.allclose(np.sort(nodes[:, :3], 1), [[1, 2, 3]] * 2)
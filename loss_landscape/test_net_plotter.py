@@ -0,0 +1,67 @@
+import copy
+import numpy as np
+import torch
+import torch.nn as nn
+import net_plotter
+
+
+def small_net():
+    return nn.Sequential(nn.Linear(4, 3), nn.BatchNorm1d(3), nn.Linear(3, 2))
+
+
+def test_step_weights(make_net):
+    net = make_net(small_net)
+    params = list(net.parameters())
+    w = [p.data.clone() for p in params]
+    d = [[np.random.RandomState(i).randn(*p.shape).astype(np.float32) for p in params] for i in range(2)]
+    perturbation = net_plotter.get_perturbation(net, w, None, d, 'weights')
+
+    perturbation.step([0.5, -2.0])
+    for p, p0, dx, dy in zip(net.parameters(), w, d[0], d[1]):
+        assert torch.allclose(p, p0 + 0.5 * torch.from_numpy(dx) - 2.0 * torch.from_numpy(dy), atol=1e-6)
+    # the parameters are updated in place, not replaced
+    assert all(p is q for p, q in zip(net.parameters(), params))
+
+    perturbation.reset()
+    for p, p0 in zip(net.parameters(), w):
+        assert torch.equal(p, p0)
+
+
+def test_step_states(make_net):
+    net = make_net(small_net)
+    s = copy.deepcopy(net.state_dict())
+    d = [[torch.ones_like(v, dtype=torch.float32) for v in s.values()]]
+    perturbation = net_plotter.get_perturbation(net, None, s, d, 'states')
+
+    perturbation.step(0.25)
+    for k, v in net.state_dict().items():
+        if v.is_floating_point():
+            assert torch.allclose(v, s[k] + 0.25)
+        else:
+            # e.g., BN's num_batches_tracked
+            assert torch.equal(v, s[k])
+
+    perturbation.reset()
+    for k, v in net.state_dict().items():
+        assert torch.equal(v, s[k])
+
+
+def test_set_weights_states(make_net):
+    net = make_net(small_net)
+    w = [p.data.clone() for p in net.parameters()]
+    s = copy.deepcopy(net.state_dict())
+    d = [[torch.ones_like(p) for p in w], [2 * torch.ones_like(p) for p in w]]
+
+    net_plotter.set_weights(net, w, d, [0.5, -1.0])
+    for p, p0 in zip(net.parameters(), w):
+        assert torch.allclose(p, p0 - 1.5)
+    net_plotter.set_weights(net, w)
+    for p, p0 in zip(net.parameters(), w):
+        assert torch.equal(p, p0)
+
+    net_plotter.set_states(net, s, [[torch.ones_like(v, dtype=torch.float32) for v in s.values()]], 0.25)
+    for k, v in net.state_dict().items():
+        assert torch.allclose(v, s[k] + 0.25) if v.is_floating_point() else torch.equal(v, s[k])
+    net_plotter.set_states(net, s)
+    for k, v in net.state_dict().items():
+        assert torch.equal(v, s[k])
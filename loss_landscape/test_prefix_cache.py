@@ -0,0 +1,78 @@
+import pytest
+import torch
+import torch.nn as nn
+import prefix_cache
+import cifar10.models.vgg as vgg
+import cifar10.models.resnet as resnet
+import cifar10.models.densenet as densenet
+
+
+NETS = {
+    'resnet': lambda: resnet.ResNet(resnet.BasicBlock, [1, 1, 1, 1]),
+    'resnet_bottleneck_noshort': lambda: resnet.ResNet(resnet.Bottleneck_noshortcut, [1, 1, 1, 1]),
+    'resnet_cifar': lambda: resnet.ResNet_cifar(resnet.BasicBlock, [2, 1, 1]),
+    'wresnet_cifar': lambda: resnet.WResNet_cifar(resnet.BasicBlock_noshortcut, [1, 1, 1], 2),
+    'vgg9': lambda: vgg.VGG9(),
+    'densenet': lambda: densenet.DenseNet(densenet.Bottleneck, [2, 1, 1, 1], growth_rate=4),
+}
+
+
+@pytest.mark.parametrize('name', sorted(NETS))
+def test_suffix_net(name, make_net):
+    net = make_net(NETS[name])
+    batches = [(torch.randn(3, 3, 32, 32), torch.randint(0, 10, (3,))) for i in range(2)]
+    with torch.no_grad():
+        expected = [net(x) for x, y in batches]
+    stages = prefix_cache.get_stages(net)
+    assert stages[-1][0] == [name for name, m in net.named_children() if isinstance(m, nn.Linear)][-1:]
+
+    for k in range(len(stages)):
+        cached = prefix_cache.cache_prefix(net, k, batches)
+        suffix = prefix_cache.SuffixNet(net, k).eval()
+        with torch.no_grad():
+            for (inputs, targets), (x, y), out in zip(cached, batches, expected):
+                assert torch.equal(targets, y)
+                assert torch.allclose(suffix(inputs), out, atol=1e-5)
+
+
+def test_cache_prefix_file(tmp_path, make_net):
+    net = make_net(NETS['resnet_cifar'])
+    dataset = torch.utils.data.TensorDataset(torch.randn(5, 3, 32, 32), torch.randint(0, 10, (5,)))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2)
+    cached = prefix_cache.cache_prefix(net, 3, loader, str(tmp_path / 'prefix'))
+    suffix = prefix_cache.SuffixNet(net, 3).eval()
+    with torch.no_grad():
+        outputs = torch.cat([suffix(inputs) for inputs, targets in cached])
+        assert torch.allclose(outputs, net(dataset.tensors[0]), atol=1e-5)
+    assert torch.equal(torch.cat([targets for inputs, targets in cached]), dataset.tensors[1])
+
+    # an empty loader leaves no cache files behind
+    empty = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(dataset.tensors[0][:0],
+                                        dataset.tensors[1][:0]), batch_size=2)
+    with pytest.raises(AssertionError, match='empty loader'):
+        prefix_cache.cache_prefix(net, 3, empty, str(tmp_path / 'empty'))
+    assert len(list(tmp_path.iterdir())) == 2 and not list(tmp_path.glob('empty*'))
+
+
+def test_cache_prefix_fingerprint(tmp_path, make_net):
+    dataset = torch.utils.data.TensorDataset(torch.randn(5, 3, 32, 32), torch.randint(0, 10, (5,)))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2)
+    cache_file = str(tmp_path / 'prefix')
+    net = make_net(NETS['resnet_cifar'])
+    prefix_cache.cache_prefix(net, 3, loader, cache_file)
+
+    # another net with the same cache_file computes its own activations
+    other = make_net(NETS['resnet_cifar'])
+    with torch.no_grad():
+        other.conv1.weight.mul_(2)
+    cached = prefix_cache.cache_prefix(other, 3, loader, cache_file)
+    suffix = prefix_cache.SuffixNet(other, 3).eval()
+    with torch.no_grad():
+        outputs = torch.cat([suffix(inputs) for inputs, targets in cached])
+        assert torch.allclose(outputs, other(dataset.tensors[0]), atol=1e-5)
+    assert len(list(tmp_path.glob('prefix_*_data.npy'))) == 2
+
+    # as do other data options, while the same net and data reuse the files
+    prefix_cache.cache_prefix(net, 3, loader, cache_file, data_key='raw_data')
+    prefix_cache.cache_prefix(net, 3, loader, cache_file)
+    assert len(list(tmp_path.glob('prefix_*_data.npy'))) == 3
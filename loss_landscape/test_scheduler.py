@@ -0,0 +1,48 @@
+import numpy as np
+import scheduler
+
+
+def grid_inds(xs, ys, nx):
+    return {x + y * nx for x in xs for y in ys}
+
+
+def test_progressive_order():
+    nx = ny = 9
+    inds = np.arange(nx * ny)
+    order = scheduler.progressive_order(inds, nx, ny)
+    assert sorted(order) == list(inds)
+    # every prefix of the order is a coarser sub-grid
+    assert set(order[:4]) == grid_inds([0, 8], [0, 8], nx)
+    assert set(order[:9]) == grid_inds([0, 4, 8], [0, 4, 8], nx)
+    assert set(order[:25]) == grid_inds(range(0, 9, 2), range(0, 9, 2), nx)
+
+
+def test_progressive_order_subset():
+    nx, ny = 5, 3
+    inds = np.array([1, 2, 4, 7, 14])
+    order = scheduler.progressive_order(inds, nx, ny)
+    # the corners first, then x = 2, then the odd rows and columns, in the given order
+    assert list(order) == [4, 14, 2, 1, 7]
+
+
+def test_snake_order():
+    nx = 4
+    order = scheduler.snake_order(np.arange(12), nx)
+    assert list(order) == [0, 1, 2, 3, 7, 6, 5, 4, 8, 9, 10, 11]
+    # consecutive points are neighbors on the grid
+    ix, iy = order % nx, order // nx
+    assert np.all(np.abs(np.diff(ix)) + np.abs(np.diff(iy)) == 1)
+
+    # the unfilled points of a partially calculated grid keep the same path
+    assert list(scheduler.snake_order(np.array([11, 6, 4, 0]), nx)) == [0, 6, 4, 11]
+
+
+def test_work_queue():
+    done = np.zeros((4, 3), dtype=bool)
+    done[1, 2] = done[3, 0] = True
+    xcoordinates, ycoordinates = np.linspace(-1, 1, 3), np.linspace(-1, 1, 4)
+    inds, coords = scheduler.get_unplotted_indices(done, xcoordinates, ycoordinates)
+    jobs = list(scheduler.WorkQueue(inds, coords, chunk_size=5))
+    # the chunks hand out the indices together with their coordinates
+    assert [ind for ind, coord in jobs] == list(inds)
+    assert np.array_equal(np.array([coord for ind, coord in jobs]), coords)
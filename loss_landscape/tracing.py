@@ -0,0 +1,112 @@
+"""
+    Structured tracing of the evaluation of a surface.
+
+    Spans of the steps of each point (weight update, data loading, forward, metric
+    reduction, MPI sync, HDF5 write) are recorded per rank and local worker process,
+    gathered on rank 0 and exported as a Chrome trace (chrome://tracing or Perfetto)
+    and as a JSONL summary with one line per rank and span name.
+
+    Tracing is off until setup() is called. Until then span() returns a shared
+    no-op context manager and iterate() the plain iterator of the loader.
+"""
+
+import os
+import time
+import json
+import contextlib
+import mpi4pytorch as mpi
+
+# the tracer of the current process, None if tracing is off
+tracer = None
+null_span = contextlib.nullcontext()
+
+
+class Tracer(object):
+    """ Collect the (name, start, duration, pid, args) spans of one process. """
+
+    def __init__(self, rank=0):
+        self.rank = rank
+        self.events = []
+
+    @contextlib.contextmanager
+    def span(self, name, args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.events.append((name, start, time.time() - start, os.getpid(), args))
+
+
+def setup(rank=0):
+    """ Turn tracing on in the current process. """
+    global tracer
+    tracer = Tracer(rank)
+
+
+def span(name, **args):
+    """ A context manager recording the time spent in its block as the span 'name'. """
+    if tracer is None:
+        return null_span
+    return tracer.span(name, args)
+
+
+def iterate(loader, name='data'):
+    """ Iterate over the batches of a loader, recording the time to get each batch. """
+    if tracer is None:
+        return iter(loader)
+    return traced_iter(loader, name)
+
+
+def traced_iter(loader, name):
+    batches = iter(loader)
+    while True:
+        with tracer.span(name, {}):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        yield batch
+
+
+def drain():
+    """ Take the spans recorded so far, e.g., to return them from a worker process. """
+    if tracer is None:
+        return []
+    events, tracer.events = tracer.events, []
+    return events
+
+
+def add(events):
+    """ Add spans recorded by another process, e.g., a local worker, of the same rank. """
+    if tracer is not None:
+        tracer.events.extend(events)
+
+
+def export(trace_file, comm=None):
+    """
+    Gather the spans of all ranks on rank 0 and write '<trace_file>.json' in the
+    Chrome trace format, with one process per rank and one thread per OS process,
+    and '<trace_file>.jsonl' with the count, total, mean and max duration (in
+    seconds) of every span name per rank.
+    """
+    events = mpi.gather(comm, (tracer.rank, drain()))
+    if events is None:
+        return
+
+    trace, summary = [], {}
+    for rank, rank_events in events:
+        trace.append({'name': 'process_name', 'ph': 'M', 'pid': rank, 'args': {'name': 'rank %d' % rank}})
+        for name, start, duration, pid, args in rank_events:
+            trace.append({'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                          'pid': rank, 'tid': pid, 'args': args})
+            stats = summary.setdefault((rank, name), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    with open(trace_file + '.json', 'w') as fp:
+        json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, fp)
+    with open(trace_file + '.jsonl', 'w') as fp:
+        for (rank, name), (count, total, longest) in sorted(summary.items()):
+            fp.write(json.dumps({'rank': rank, 'span': name, 'count': count, 'total': total,
+                                 'mean': total / count, 'max': longest}) + '\n')
+    print('Saved the trace to %s.json and the summary to %s.jsonl' % (trace_file, trace_file))